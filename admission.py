@@ -0,0 +1,119 @@
+import time
+from collections import OrderedDict
+
+import metrics
+from config import (
+    LOGIN_IP_PER_MINUTE, LOGIN_IP_BURST, LOGIN_USER_PER_MINUTE, LOGIN_USER_BURST,
+    LOGIN_MAX_CONCURRENT, LOGIN_LIMITER_KEYS,
+)
+
+# Результаты входа, которые тратят лимит логина: неверный пароль и подбор логинов
+FAILED_RESULTS = ("bad_password", "not_found")
+# Длиннее логин в ключ лимитера не попадает: память на ключ ограничена
+MAX_KEY_LENGTH = 64
+
+class KeyedRateLimiter:
+    """Token bucket на ключ (IP, логин): per_minute попыток в минуту, запас burst.
+
+    Ключей не больше maxsize, вытесняются давно не встречавшиеся - их
+    корзины к этому времени всё равно бы наполнились. per_minute <= 0
+    отключает лимит.
+    """
+
+    def __init__(self, per_minute: float, burst: int, maxsize: int):
+        self.enabled = per_minute > 0
+        self.rate = per_minute / 60
+        self.capacity = max(1, burst)
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def _tokens(self, key, now: float) -> float:
+        entry = self._buckets.get(key)
+        if entry is None:
+            return float(self.capacity)
+        tokens, updated = entry
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def retry_after(self, key) -> float:
+        """0 - попытка разрешена, иначе через сколько секунд появится токен."""
+        if not self.enabled:
+            return 0.0
+        tokens = self._tokens(key, time.monotonic())
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, key):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+class LoginAdmission:
+    """Допуск к /auth/login до обращения к БД и bcrypt.
+
+    По порядку: общий лимит одновременных проверок пароля, лимит попыток
+    с IP (тратится каждой попыткой) и лимит логина (тратится только
+    неудачными - владельца не блокирует его же успешный лоадер). Всё в
+    памяти процесса: при нескольких воркерах API лимиты у каждого свои.
+    """
+
+    def __init__(self, ip_per_minute: float, ip_burst: int, user_per_minute: float, user_burst: int,
+                 max_concurrent: int, max_keys: int):
+        self.by_ip = KeyedRateLimiter(ip_per_minute, ip_burst, max_keys)
+        self.by_user = KeyedRateLimiter(user_per_minute, user_burst, max_keys)
+        self.max_concurrent = max(1, max_concurrent)
+        self.in_flight = 0
+
+    def admit(self, ip: str, username: str) -> float:
+        """0 - попытка допущена (после неё обязателен release), иначе Retry-After в секундах."""
+        if self.in_flight >= self.max_concurrent:
+            metrics.LOGIN_ADMISSION.inc("overloaded")
+            return 1.0
+        retry_after = self.by_ip.retry_after(ip)
+        if retry_after:
+            metrics.LOGIN_ADMISSION.inc("ip_limited")
+            return retry_after
+        retry_after = self.by_user.retry_after(username[:MAX_KEY_LENGTH])
+        if retry_after:
+            # Попытка с IP всё равно засчитывается: перебор логинов с одного адреса
+            self.by_ip.consume(ip)
+            metrics.LOGIN_ADMISSION.inc("user_limited")
+            return retry_after
+        self.by_ip.consume(ip)
+        self.in_flight += 1
+        metrics.LOGIN_ADMISSION.inc("admitted")
+        return 0.0
+
+    def release(self, username: str, result: str):
+        self.in_flight -= 1
+        if result in FAILED_RESULTS:
+            self.by_user.consume(username[:MAX_KEY_LENGTH])
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "tracked_ips": len(self.by_ip),
+            "tracked_users": len(self.by_user),
+        }
+
+admission = LoginAdmission(
+    LOGIN_IP_PER_MINUTE, LOGIN_IP_BURST, LOGIN_USER_PER_MINUTE, LOGIN_USER_BURST,
+    LOGIN_MAX_CONCURRENT, LOGIN_LIMITER_KEYS,
+)
+
+def admit(ip: str, username: str) -> float:
+    return admission.admit(ip, username)
+
+def release(username: str, result: str):
+    admission.release(username, result)
+
+def stats() -> dict:
+    return admission.stats()
+
+metrics.register_stats("matrix_login_admission", "Login admission control state", stats)
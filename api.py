@@ -1,17 +1,141 @@
-from fastapi import FastAPI, HTTPException, Depends, Response
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
-from passlib.context import CryptContext
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
 import httpx
+import logging
+import secrets
+import math
+import time
+import uuid
 
+import admission
+import artifacts
+import audit
+import bot
 import database
-from config import SECRET_KEY, CLIENT_JAR_URL, LOADER_VERSION, LOADER_DOWNLOAD_URL, LOADER_CHANGELOG
+import export
+import metrics
+import passwords
+import releases
+import sessions
+from config import (
+    SECRET_KEY, ACCESS_TOKEN_TTL_MINUTES, REFRESH_TOKEN_TTL_DAYS, CLIENT_JAR_URL,
+    UPSTREAM_MAX_CONNECTIONS, UPSTREAM_KEEPALIVE_CONNECTIONS, DOWNLOAD_CHUNK_SIZE,
+    ARTIFACT_CACHE_DIR, ARTIFACT_REVALIDATE_SECONDS, ARTIFACT_KEEP_VERSIONS,
+    BOT_ENABLED, BOT_WEBHOOK_URL, BOT_WEBHOOK_SECRET, METRICS_TOKEN, EXPORT_TOKEN,
+    TRUST_PROXY_HEADERS, TRUSTED_PROXY_HOPS,
+)
+from telegram import Update
 
-app = FastAPI(title="Matrix API")
+logger = logging.getLogger(__name__)
+
+# Как часто удалять истёкшие refresh- и отозванные токены
+TOKEN_PRUNE_INTERVAL = 3600
+
+class MetricsMiddleware:
+    """Счётчик и гистограмма по шаблону маршрута (не по сырому пути)."""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route_label(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {
+                route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")
+            }
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self._route_label(scope)
+            metrics.HTTP_LATENCY.observe(time.perf_counter() - started, scope["method"], route)
+            metrics.HTTP_REQUESTS.inc(scope["method"], route, status)
+
+# Общий HTTP клиент с keep-alive, создаётся на старте приложения
+http_client: httpx.AsyncClient = None
+token_prune_task: asyncio.Task = None
+
+# Telegram бот на том же event loop, запускается на старте API
+bot_application = None
+WEBHOOK_PATH = "/telegram/webhook"
+# Telegram допускает в secret_token только [A-Za-z0-9_-]
+webhook_secret = BOT_WEBHOOK_SECRET or hashlib.sha256(f"webhook:{SECRET_KEY}".encode()).hexdigest()
+
+artifact_cache = artifacts.ArtifactCache(
+    CLIENT_JAR_URL, ARTIFACT_CACHE_DIR, ARTIFACT_REVALIDATE_SECONDS, DOWNLOAD_CHUNK_SIZE, ARTIFACT_KEEP_VERSIONS
+) if ARTIFACT_CACHE_DIR else None
+
+async def prune_tokens_loop():
+    while True:
+        await asyncio.sleep(TOKEN_PRUNE_INTERVAL)
+        try:
+            await database.prune_expired_tokens()
+        except Exception:
+            logger.warning("Failed to prune expired tokens", exc_info=True)
+
+# Запуск и остановка: БД, HTTP клиент, кэш JAR и встроенный бот
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, token_prune_task, bot_application
+    await database.init_db()
+    token_prune_task = asyncio.create_task(prune_tokens_loop())
+    http_client = httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_KEEPALIVE_CONNECTIONS,
+        ),
+    )
+    if artifact_cache is not None:
+        await artifact_cache.start(http_client)
+    audit.start()
+    if BOT_ENABLED:
+        bot_application = bot.build_application(standalone=False, webhook=bool(BOT_WEBHOOK_URL))
+        await bot.start_embedded(
+            bot_application,
+            webhook_url=BOT_WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH if BOT_WEBHOOK_URL else "",
+            webhook_secret=webhook_secret,
+        )
+    
+    yield
+    
+    # Бот останавливается первым: его обработчики ещё пользуются БД
+    if bot_application is not None:
+        await bot.stop_embedded(bot_application)
+    token_prune_task.cancel()
+    await audit.stop()
+    if artifact_cache is not None:
+        await artifact_cache.stop()
+    await http_client.aclose()
+    await database.close_db()
+
+app = FastAPI(title="Matrix API", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 class UpdateCheckResponse(BaseModel):
     update_available: bool
@@ -28,93 +152,286 @@ class LoginResponse(BaseModel):
     success: bool
     message: str = ""
     token: str = ""
+    refresh_token: str = ""
     username: str = ""
     expires_at: str = ""
 
-def create_token(username: str) -> str:
-    expire = datetime.utcnow() + timedelta(hours=24)
+class RefreshRequest(BaseModel):
+    refresh_token: str
+    hwid: str
+    access_token: str = ""
+
+def create_token(username: str, generation: int = 0, subscription_expires: int = None) -> str:
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_TTL_MINUTES)
+    # Токен не переживает подписку, поэтому /client/download не проверяет её заново
+    if subscription_expires is not None:
+        expire = min(expire, datetime.utcfromtimestamp(subscription_expires))
     return jwt.encode(
-        {"sub": username, "exp": expire},
+        {"sub": username, "exp": expire, "jti": uuid.uuid4().hex, "gen": generation},
         SECRET_KEY,
         algorithm="HS256"
     )
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+def decode_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=["HS256"])
-        return payload.get("sub")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    # Бан, сброс HWID и logout отзывают токены без запроса к БД
+    if not sessions.is_valid(payload.get("sub"), payload.get("gen", 0), payload.get("jti")):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    return payload
+
+def verify_token(payload: dict = Depends(decode_token)) -> str:
+    return payload.get("sub")
+
+def hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+async def issue_refresh_token(username: str, hwid: str, generation: int, family: str = None) -> str:
+    refresh_token = secrets.token_urlsafe(32)
+    await database.create_refresh_token(
+        hash_refresh_token(refresh_token),
+        username,
+        hwid,
+        family or uuid.uuid4().hex,
+        generation,
+        int(time.time()) + REFRESH_TOKEN_TTL_DAYS * 86400,
+    )
+    return refresh_token
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY_HEADERS:
+        # Всё левее записей наших прокси прислал сам клиент - им верить нельзя
+        hops = [
+            hop.strip()
+            for header in request.headers.getlist("X-Forwarded-For")
+            for hop in header.split(",")
+            if hop.strip()
+        ]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else ""
 
 @app.post("/auth/login", response_model=LoginResponse)
-async def login(request: LoginRequest):
-    user = await database.get_user_by_username(request.username)
+async def login(request: LoginRequest, http_request: Request):
+    ip = client_ip(http_request)
+    # Отсев до БД и bcrypt; в журнал отклонённые не пишутся, чтобы перебор
+    # не превращался в поток записей (они видны в matrix_login_admission_total)
+    retry_after = admission.admit(ip, request.username)
+    if retry_after:
+        raise HTTPException(
+            status_code=429, detail="Too many login attempts", headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
+    started = time.perf_counter()
+    result = "error"
+    try:
+        response, result = await authenticate(request)
+        return response
+    except passwords.PasswordPoolBusy:
+        result = "busy"
+        raise HTTPException(status_code=503, detail="Server busy", headers={"Retry-After": "1"})
+    finally:
+        admission.release(request.username, result)
+        # Запись в журнал не ждёт БД: событие уходит в очередь audit
+        audit.record(request.username, request.hwid, ip, result, time.perf_counter() - started)
+
+async def authenticate(request: LoginRequest):
+    user = await database.authenticate_candidate(request.username)
     
     if not user:
-        return LoginResponse(success=False, message="Пользователь не найден")
+        return LoginResponse(success=False, message="Пользователь не найден"), "not_found"
+    
+    password_ok, new_hash = await passwords.verify_password(request.password, user['password_hash'])
+    
+    if not password_ok:
+        return LoginResponse(success=False, message="Неверный пароль"), "bad_password"
     
-    if not pwd_context.verify(request.password, user['password_hash']):
-        return LoginResponse(success=False, message="Неверный пароль")
+    # Стоимость bcrypt изменилась в конфиге - пересчитываем хеш
+    if new_hash:
+        await database.update_password_hash(request.username, new_hash)
     
     if not user['is_active']:
-        return LoginResponse(success=False, message="Аккаунт заблокирован")
+        return LoginResponse(success=False, message="Аккаунт заблокирован"), "banned"
     
     # Проверка подписки
-    has_sub = await database.check_subscription(request.username)
-    if not has_sub:
-        return LoginResponse(success=False, message="Подписка истекла")
+    if not user['has_subscription']:
+        return LoginResponse(success=False, message="Подписка истекла"), "expired"
     
     # Проверка HWID
     if user['hwid'] and user['hwid'] != request.hwid:
-        return LoginResponse(success=False, message="HWID не совпадает. Обратитесь в поддержку")
+        return LoginResponse(success=False, message="HWID не совпадает. Обратитесь в поддержку"), "hwid_mismatch"
     
     # Привязка HWID если ещё не привязан
     if not user['hwid']:
         await database.update_hwid(request.username, request.hwid)
     
-    token = create_token(request.username)
+    token = create_token(request.username, user['token_generation'], user['subscription_expires'])
+    refresh_token = await issue_refresh_token(request.username, request.hwid, user['token_generation'])
     
     return LoginResponse(
         success=True,
         token=token,
+        refresh_token=refresh_token,
         username=request.username,
         expires_at=user['subscription_end'] or ""
+    ), "ok"
+
+@app.post("/auth/refresh", response_model=LoginResponse)
+async def refresh(request: RefreshRequest):
+    # Без bcrypt: sha256 от токена и поиск по первичному ключу
+    stored = await database.consume_refresh_token(hash_refresh_token(request.refresh_token))
+    if not stored:
+        return LoginResponse(success=False, message="Сессия истекла, войдите заново")
+    
+    username = stored['username']
+    if stored['hwid'] != request.hwid:
+        return LoginResponse(success=False, message="HWID не совпадает. Обратитесь в поддержку")
+    
+    # Старый access-токен может быть просрочен, но должен принадлежать тому же пользователю
+    if request.access_token:
+        try:
+            claims = jwt.decode(
+                request.access_token, SECRET_KEY, algorithms=["HS256"], options={"verify_exp": False}
+            )
+        except JWTError:
+            return LoginResponse(success=False, message="Сессия истекла, войдите заново")
+        if claims.get("sub") != username:
+            return LoginResponse(success=False, message="Сессия истекла, войдите заново")
+    
+    # Бан и сброс HWID меняют поколение и отзывают refresh-токены
+    if stored['generation'] != sessions.generation(username):
+        return LoginResponse(success=False, message="Сессия истекла, войдите заново")
+    
+    user = await database.authenticate_candidate(username)
+    if not user or not user['is_active']:
+        return LoginResponse(success=False, message="Аккаунт заблокирован")
+    if not user['has_subscription']:
+        return LoginResponse(success=False, message="Подписка истекла")
+    if user['hwid'] and user['hwid'] != request.hwid:
+        return LoginResponse(success=False, message="HWID не совпадает. Обратитесь в поддержку")
+    
+    token = create_token(username, user['token_generation'], user['subscription_expires'])
+    refresh_token = await issue_refresh_token(username, request.hwid, user['token_generation'], stored['family'])
+    
+    return LoginResponse(
+        success=True,
+        token=token,
+        refresh_token=refresh_token,
+        username=username,
+        expires_at=user['subscription_end'] or ""
     )
 
+@app.post("/auth/logout")
+async def logout(payload: dict = Depends(decode_token)):
+    if payload.get("jti"):
+        await database.revoke_token(payload["jti"], int(payload["exp"]))
+    return {"success": True}
+
 @app.get("/client/download")
-async def download_client(username: str = Depends(verify_token)):
-    # Проверяем подписку ещё раз
-    has_sub = await database.check_subscription(username)
-    if not has_sub:
-        raise HTTPException(status_code=403, detail="Subscription expired")
-    
-    # Скачиваем JAR из облака и отдаём клиенту
-    async with httpx.AsyncClient(follow_redirects=True, timeout=60.0) as client:
-        response = await client.get(CLIENT_JAR_URL)
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Failed to fetch client")
-        
-        return Response(
-            content=response.content,
-            media_type="application/java-archive",
-            headers={"Content-Disposition": "attachment; filename=client.jar"}
+async def download_client(request: Request, username: str = Depends(verify_token)):
+    # Подписку повторно не проверяем: срок токена ограничен сроком подписки,
+    # а бан и укороченная подписка отзывают токен
+    if artifact_cache is None:
+        return await proxy_client_download()
+    
+    # Отдаём JAR с диска; при пустом кэше все запросы ждут одну загрузку
+    try:
+        artifact = await artifact_cache.get()
+    except artifacts.ArtifactFetchError:
+        raise HTTPException(status_code=500, detail="Failed to fetch client")
+    
+    return artifacts.serve(request, artifact, filename="client.jar", chunk_size=DOWNLOAD_CHUNK_SIZE)
+
+@app.get("/client/delta")
+async def download_client_delta(request: Request, from_sha256: str = Query(..., alias="from"),
+                                username: str = Depends(verify_token)):
+    # from - X-Content-SHA256 установленной у клиента версии. 404 - дельты
+    # нет (версия слишком старая или дельта ещё строится), клиент качает
+    # /client/download. X-Content-SHA256 ответа - хэш собранного JAR
+    if artifact_cache is None:
+        raise HTTPException(status_code=404, detail="Delta not available")
+    try:
+        delta = await artifact_cache.get_delta(from_sha256.lower())
+    except artifacts.ArtifactFetchError:
+        raise HTTPException(status_code=500, detail="Failed to fetch client")
+    if delta is None:
+        raise HTTPException(status_code=404, detail="Delta not available")
+    return artifacts.serve(request, delta, filename="client.delta.zip", chunk_size=DOWNLOAD_CHUNK_SIZE,
+                           media_type="application/zip")
+
+async def proxy_client_download():
+    # Проксируем JAR из облака потоком, не держа весь файл в памяти
+    try:
+        upstream = await http_client.send(
+            http_client.build_request("GET", CLIENT_JAR_URL, headers={"Accept-Encoding": "identity"}),
+            stream=True,
         )
+    except httpx.HTTPError:
+        raise HTTPException(status_code=500, detail="Failed to fetch client")
+    if upstream.status_code != 200:
+        await upstream.aclose()
+        raise HTTPException(status_code=500, detail="Failed to fetch client")
+    
+    headers = {"Content-Disposition": "attachment; filename=client.jar"}
+    for name in ("Content-Length", "ETag"):
+        if name in upstream.headers:
+            headers[name] = upstream.headers[name]
+    
+    return StreamingResponse(
+        count_upstream_bytes(upstream, time.perf_counter()),
+        media_type="application/java-archive",
+        headers=headers,
+        background=BackgroundTask(upstream.aclose),
+    )
 
-@app.get("/update/check", response_model=UpdateCheckResponse)
-async def check_update(version: str = "0.0.0"):
-    # Сравниваем версии
-    current_parts = [int(x) for x in version.split(".")]
-    latest_parts = [int(x) for x in LOADER_VERSION.split(".")]
-    
-    update_available = latest_parts > current_parts
-    
-    return UpdateCheckResponse(
-        update_available=update_available,
-        latest_version=LOADER_VERSION,
-        download_url=LOADER_DOWNLOAD_URL if update_available else "",
-        changelog=LOADER_CHANGELOG if update_available else ""
+async def count_upstream_bytes(upstream: httpx.Response, started: float):
+    try:
+        async for chunk in upstream.aiter_raw(DOWNLOAD_CHUNK_SIZE):
+            metrics.UPSTREAM_BYTES.inc("proxy", amount=len(chunk))
+            yield chunk
+    finally:
+        metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - started, "proxy", str(upstream.status_code))
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/export", include_in_schema=False)
+async def export_users(request: Request, fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                       since_id: int = None, since_updated: int = None, audit: bool = False):
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {EXPORT_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    # Пачки из БД уходят клиенту по мере чтения, вся таблица в памяти не собирается
+    return StreamingResponse(
+        export.stream(fmt, since_id, since_updated, with_audit=audit),
+        media_type=export.FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=users.{fmt}"},
     )
 
-@app.on_event("startup")
-async def startup():
-    await database.init_db()
+@app.get("/update/check", response_model=UpdateCheckResponse)
+async def check_update(request: Request, version: str = "0.0.0", channel: str = releases.DEFAULT_CHANNEL):
+    # Ответ собран заранее, лоадеры с тем же ETag получают 304 без тела
+    prepared = releases.check(channel, version)
+    headers = {"ETag": prepared.etag, "Cache-Control": releases.CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and artifacts.etag_matches(if_none_match, prepared.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(prepared.body, media_type="application/json", headers=headers)
+
+@app.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    if bot_application is None or not BOT_WEBHOOK_URL:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), webhook_secret):
+        raise HTTPException(status_code=403)
+    update = Update.de_json(await request.json(), bot_application.bot)
+    await bot_application.update_queue.put(update)
+    return Response(status_code=200)
@@ -0,0 +1,387 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+
+import anyio
+import httpx
+from starlette.requests import Request
+from starlette.responses import Response
+
+import metrics
+import zipdelta
+
+logger = logging.getLogger(__name__)
+
+class ArtifactFetchError(Exception):
+    pass
+
+class Artifact:
+    __slots__ = ("url", "etag", "sha256", "size", "path")
+
+    def __init__(self, url: str, etag: str, sha256: str, size: int, path: str):
+        self.url = url
+        self.etag = etag
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+
+    @property
+    def http_etag(self) -> str:
+        return f'"{self.sha256}"'
+
+class ArtifactCache:
+    """Локальная копия файла с CLIENT_JAR_URL.
+
+    Ключ - URL и ETag апстрима. Файл пишется во временный и атомарно
+    переименовывается, метаданные лежат рядом в JSON. Параллельные промахи
+    ждут одну и ту же загрузку, фоновая задача периодически
+    перепроверяет апстрим условным запросом.
+
+    Хранятся keep_versions последних версий (history, новые первыми) и
+    дельты от каждой из них к текущей; дельты строятся в потоке после
+    появления новой версии.
+    """
+
+    def __init__(self, url: str, cache_dir: str, revalidate_seconds: float, chunk_size: int, keep_versions: int = 2):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.revalidate_seconds = revalidate_seconds
+        self.chunk_size = chunk_size
+        self.keep_versions = max(2, keep_versions)
+        self.key = hashlib.sha256(url.encode()).hexdigest()[:16]
+        self.current: Artifact = None
+        self.history = []
+        self.client: httpx.AsyncClient = None
+        self._inflight: asyncio.Task = None
+        self._revalidate_task: asyncio.Task = None
+        self._delta_task: asyncio.Task = None
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.cache_dir, f"{self.key}.json")
+
+    def _jar_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.key}-{sha256}.jar")
+
+    def _delta_path(self, from_sha256: str, to_sha256: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.key}-delta-{from_sha256}-{to_sha256}.zip")
+
+    def _load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        path = os.path.join(self.cache_dir, meta.get("file", ""))
+        if meta.get("url") != self.url or not os.path.isfile(path):
+            return
+        if os.path.getsize(path) != meta.get("size"):
+            return
+        self.current = Artifact(self.url, meta.get("etag"), meta["sha256"], meta["size"], path)
+        history = [sha256 for sha256 in meta.get("history", []) if os.path.isfile(self._jar_path(sha256))]
+        if meta["sha256"] not in history:
+            history.insert(0, meta["sha256"])
+        self.history = history[:self.keep_versions]
+
+    def _write_meta(self, artifact: Artifact):
+        meta = {
+            "url": artifact.url,
+            "etag": artifact.etag,
+            "sha256": artifact.sha256,
+            "size": artifact.size,
+            "file": os.path.basename(artifact.path),
+            "history": self.history,
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{self.key}-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp, self._meta_path)
+        except BaseException:
+            _unlink(tmp)
+            raise
+
+    def _prune(self, history: list):
+        keep = {self._jar_path(sha256) for sha256 in history}
+        keep.update(self._delta_path(sha256, history[0]) for sha256 in history[1:])
+        prefix = f"{self.key}-"
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(prefix) and name.endswith((".jar", ".zip")) and path not in keep:
+                _unlink(path)
+
+    def _build_deltas(self, history: list):
+        target_sha256 = history[0]
+        target = self._jar_path(target_sha256)
+        target_size = os.path.getsize(target)
+        for sha256 in history[1:]:
+            source = self._jar_path(sha256)
+            path = self._delta_path(sha256, target_sha256)
+            if os.path.exists(path) or not os.path.isfile(source):
+                continue
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{self.key}-", suffix=".zip")
+            os.close(fd)
+            check = tmp + ".check"
+            try:
+                started = time.perf_counter()
+                copied = zipdelta.build(source, target, tmp, sha256, target_sha256)
+                # Публикуем только проверенную дельту, которая заметно меньше полного файла
+                if zipdelta.apply(source, tmp, check) != target_sha256:
+                    raise zipdelta.DeltaError("Delta does not reproduce the target")
+                size = os.path.getsize(tmp)
+                if size >= target_size * 0.9:
+                    logger.info("Delta %s -> %s skipped: %d of %d bytes", sha256[:12], target_sha256[:12], size, target_size)
+                    continue
+                os.replace(tmp, path)
+                logger.info(
+                    "Delta %s -> %s: %d bytes (%d reused) in %.2fs",
+                    sha256[:12], target_sha256[:12], size, copied, time.perf_counter() - started,
+                )
+            except (OSError, zipfile.BadZipFile, zipdelta.DeltaError):
+                logger.warning("Delta %s -> %s failed", sha256[:12], target_sha256[:12], exc_info=True)
+            finally:
+                _unlink(tmp)
+                _unlink(check)
+
+    def _schedule_deltas(self):
+        if len(self.history) < 2:
+            return
+        if self._delta_task is not None:
+            self._delta_task.cancel()
+        # Поток не прерывается отменой, но результат для старой версии уже не нужен
+        self._delta_task = asyncio.create_task(asyncio.to_thread(self._build_deltas, list(self.history)))
+
+    async def start(self, client: httpx.AsyncClient):
+        self.client = client
+        await asyncio.to_thread(self._load)
+        # Дельты могли не достроиться до перезапуска
+        self._schedule_deltas()
+        self._revalidate_task = asyncio.create_task(self._revalidate_loop())
+
+    async def stop(self):
+        for task in (self._revalidate_task, self._inflight, self._delta_task):
+            if task is not None:
+                task.cancel()
+        self._revalidate_task = None
+        self._delta_task = None
+
+    async def get(self) -> Artifact:
+        current = self.current
+        if current is not None and os.path.exists(current.path):
+            return current
+        if current is not None:
+            # Файл удалил другой воркер после обновления - берём его метаданные
+            self.current = None
+            await asyncio.to_thread(self._load)
+            if self.current is not None:
+                return self.current
+        return await self.refresh()
+
+    async def get_delta(self, from_sha256: str) -> Artifact:
+        """Дельта от версии клиента к текущей или None (клиент качает полный файл)."""
+        current = await self.get()
+        if from_sha256 == current.sha256 or from_sha256 not in self.history:
+            return None
+        path = self._delta_path(from_sha256, current.sha256)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        # sha256 - хэш собранного JAR, клиент проверяет им результат применения
+        return Artifact(self.url, None, current.sha256, size, path)
+
+    async def refresh(self) -> Artifact:
+        # Single-flight: все ожидающие получают результат одной загрузки
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._fetch())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return await asyncio.shield(self._inflight)
+
+    def _clear_inflight(self, task: asyncio.Task):
+        if self._inflight is task:
+            self._inflight = None
+
+    async def _revalidate_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Artifact revalidation failed for %s", self.url, exc_info=True)
+            await asyncio.sleep(self.revalidate_seconds)
+
+    async def _fetch(self) -> Artifact:
+        current = self.current
+        headers = {"Accept-Encoding": "identity"}
+        if current is not None and current.etag:
+            headers["If-None-Match"] = current.etag
+
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self.client.stream("GET", self.url, headers=headers) as response:
+                status = str(response.status_code)
+                if response.status_code == 304 and current is not None:
+                    return current
+                if response.status_code != 200:
+                    raise ArtifactFetchError(f"Upstream returned {response.status_code}")
+                artifact = await self._download(response)
+        except httpx.HTTPError as e:
+            raise ArtifactFetchError(str(e)) from e
+        finally:
+            metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - started, "cache", status)
+
+        # Предыдущие версии оставляем: их могут ещё отдавать текущие запросы,
+        # и от них строятся дельты
+        history = [artifact.sha256] + [sha256 for sha256 in self.history if sha256 != artifact.sha256]
+        self.history = history[:self.keep_versions]
+        await asyncio.to_thread(self._write_meta, artifact)
+        self.current = artifact
+        await asyncio.to_thread(self._prune, self.history)
+        self._schedule_deltas()
+        return artifact
+
+    async def _download(self, response: httpx.Response) -> Artifact:
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{self.key}-", suffix=".part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in response.aiter_raw(self.chunk_size):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    metrics.UPSTREAM_BYTES.inc("cache", amount=len(chunk))
+                    await asyncio.to_thread(f.write, chunk)
+                await asyncio.to_thread(os.fsync, f.fileno())
+            expected = response.headers.get("Content-Length")
+            if expected is not None and int(expected) != size:
+                raise ArtifactFetchError(f"Truncated download: {size} of {expected} bytes")
+            sha256 = digest.hexdigest()
+            path = self._jar_path(sha256)
+            os.replace(tmp, path)
+        except BaseException:
+            _unlink(tmp)
+            raise
+        return Artifact(self.url, response.headers.get("ETag"), sha256, size, path)
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class FileRangeResponse(Response):
+    """Отдаёт диапазон файла с диска.
+
+    Если сервер поддерживает ASGI-расширение http.response.zerocopysend,
+    файл уходит через sendfile, иначе читается кусками фиксированного размера.
+    """
+
+    def __init__(self, path: str, offset: int, count: int, status_code: int,
+                 headers: dict, media_type: str, chunk_size: int):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.chunk_size = chunk_size
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope["method"].upper() == "HEAD" or self.count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.offset,
+                    "count": self.count,
+                })
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as f:
+            await f.seek(self.offset)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": remaining > 0,
+                })
+
+def _parse_range(header: str, size: int):
+    """Разбирает одиночный диапазон bytes=a-b. None - заголовок игнорируется,
+    (-1, -1) - диапазон невыполним (416)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return (-1, -1)
+            return (max(0, size - length), size - 1)
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        return (-1, -1)
+    return (first, min(last, size - 1))
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def serve(request: Request, artifact: Artifact, filename: str, chunk_size: int,
+          media_type: str = "application/java-archive") -> Response:
+    etag = artifact.http_etag
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "X-Content-SHA256": artifact.sha256,
+        "Content-Disposition": f"attachment; filename={filename}",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    offset, count, status_code = 0, artifact.size, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        parsed = _parse_range(range_header, artifact.size)
+        if parsed == (-1, -1):
+            headers["Content-Range"] = f"bytes */{artifact.size}"
+            return Response(status_code=416, headers=headers)
+        if parsed is not None:
+            first, last = parsed
+            offset, count, status_code = first, last - first + 1, 206
+            headers["Content-Range"] = f"bytes {first}-{last}/{artifact.size}"
+
+    headers["Content-Length"] = str(count)
+    return FileRangeResponse(artifact.path, offset, count, status_code, headers, media_type, chunk_size)
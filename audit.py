@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+
+import database
+import metrics
+from config import AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS, AUDIT_RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+class AuditWriter:
+    """Журнал попыток входа: события копятся в очереди и пишутся пачками.
+
+    record() никогда не ждёт: при переполнении очереди событие
+    отбрасывается и увеличивается счётчик dropped.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_ms: int):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self._last_prune = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def record(self, username: str, hwid: str, ip: str, result: str, latency: float):
+        try:
+            self._queue.put_nowait((int(time.time()), username, hwid, ip, result, round(latency * 1000, 3)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Дописываем то, что осталось в очереди
+        while not self._queue.empty():
+            await self._flush(self._drain([]))
+
+    def _drain(self, batch: list) -> list:
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Ждём, пока наберётся пачка или пройдёт AUDIT_FLUSH_MS
+            if self._queue.qsize() + 1 < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            await self._flush(self._drain(batch))
+            
+            if time.monotonic() - self._last_prune > 3600:
+                self._last_prune = time.monotonic()
+                try:
+                    await database.prune_login_events(int(time.time()) - AUDIT_RETENTION_DAYS * 86400)
+                except Exception:
+                    logger.warning("Failed to prune login audit", exc_info=True)
+
+    async def _flush(self, batch: list):
+        try:
+            await database.insert_login_events(batch)
+            self.written += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.warning("Failed to write %d login audit events", len(batch), exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+writer: AuditWriter = None
+
+def start():
+    global writer
+    writer = AuditWriter(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS)
+    writer.start()
+
+async def stop():
+    global writer
+    if writer is not None:
+        await writer.stop()
+        writer = None
+
+def record(username: str, hwid: str, ip: str, result: str, latency: float):
+    if writer is not None:
+        writer.record(username, hwid, ip, result, latency)
+
+def stats() -> dict:
+    """Пусто, если журнал не запущен в этом процессе."""
+    return writer.stats() if writer is not None else {}
+
+metrics.register_stats("matrix_audit_writer", "Login audit queue and write counters", stats)
@@ -0,0 +1,116 @@
+"""Нагрузочные и микро-бенчмарки.
+
+    python -m bench --users 10000 --concurrency 50 --requests 2000 --output new.json
+    python -m bench --users 10000 --compare old.json --output new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в фикстуре (1k - 1M)")
+    parser.add_argument("--db", default="", help="файл БД фикстуры (по умолчанию bench-<users>.db во временной папке)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="запросов на сценарий")
+    parser.add_argument("--iterations", type=int, default=5000, help="итераций микро-бенчмарка")
+    parser.add_argument("--scenarios", default="login,download,update")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--jar-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--bcrypt-rounds", type=int, default=None)
+    parser.add_argument("--output", default="", help="куда записать JSON с результатами")
+    parser.add_argument("--compare", default="", help="JSON предыдущего прогона для сравнения")
+    return parser.parse_args()
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def print_table(results: dict, baseline: dict = None):
+    print(f"{'benchmark':34} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for group, entries in results.items():
+        if not isinstance(entries, dict) or group == "meta":
+            continue
+        for name, r in entries.items():
+            line = f"{group + '.' + name:34} {r['throughput']:>10} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['errors']:>7}"
+            old = (baseline or {}).get(group, {}).get(name)
+            if old and old.get("throughput"):
+                change = (r["throughput"] - old["throughput"]) / old["throughput"] * 100
+                line += f"   {change:+.1f}% req/s, p99 {old['p99_ms']} -> {r['p99_ms']}"
+            print(line)
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="matrix-bench-")
+    from bench.upstream import start_stub_upstream
+    server, jar_url = start_stub_upstream(args.jar_size)
+
+    # Окружение задаётся до импорта config/api/database
+    os.environ["DATABASE_PATH"] = args.db or os.path.join(tempfile.gettempdir(), f"matrix-bench-{args.users}.db")
+    os.environ["CLIENT_JAR_URL"] = jar_url
+    os.environ["ARTIFACT_CACHE_DIR"] = os.path.join(workdir, "artifacts")
+    os.environ["BOT_ENABLED"] = "0"
+    # Все запросы идут с одного адреса ASGI-клиента: лимиты на IP и логин
+    # превратили бы замер логинов в замер 429 (общий лимит проверок остаётся)
+    os.environ.setdefault("LOGIN_IP_PER_MINUTE", "0")
+    os.environ.setdefault("LOGIN_USER_PER_MINUTE", "0")
+    if args.bcrypt_rounds is not None:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+
+    import database
+    from bench.load import run_load
+    from bench.micro import run_micro
+    from bench.seed import seed_users
+    from bench.stats import peak_rss_mb
+
+    async def run() -> dict:
+        results = {}
+        await database.init_db()
+        try:
+            created = await seed_users(args.users)
+            if created:
+                print(f"seeded {created} users into {os.environ['DATABASE_PATH']}")
+            if not args.skip_micro:
+                results["micro"] = await run_micro(args.users, args.iterations)
+        finally:
+            await database.close_db()
+        scenarios = [s for s in args.scenarios.split(",") if s]
+        if scenarios:
+            results["load"] = await run_load(args.concurrency, args.requests, scenarios)
+        return results
+
+    results = asyncio.run(run())
+    server.shutdown()
+    results["meta"] = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "iterations": args.iterations,
+        "jar_size": args.jar_size,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
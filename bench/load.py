@@ -0,0 +1,84 @@
+import asyncio
+import itertools
+import random
+import time
+
+import httpx
+
+import api
+import database
+from bench.seed import BENCH_PASSWORD
+from bench.stats import Timer
+
+async def _run_fixed_concurrency(concurrency: int, total: int, make_request) -> dict:
+    """total запросов в concurrency параллельных корутинах."""
+    timer = Timer()
+    counter = itertools.count()
+
+    async def worker():
+        while next(counter) < total:
+            started = time.perf_counter()
+            try:
+                ok = await make_request()
+            except Exception:
+                ok = False
+            timer.latencies.append(time.perf_counter() - started)
+            if not ok:
+                timer.errors += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return timer.result()
+
+async def _active_usernames(limit: int = 10_000):
+    pool = await database.get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            "SELECT username FROM users WHERE username LIKE 'bench%' AND subscription_expires > ? LIMIT ?",
+            (int(time.time()), limit),
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def run_load(concurrency: int, requests: int, scenarios) -> dict:
+    """Гоняет ASGI приложение в этом же процессе, без сети."""
+    await api.app.router.startup()
+    try:
+        usernames = await _active_usernames()
+        if not usernames:
+            raise RuntimeError("No active bench users - seed the database first")
+        transport = httpx.ASGITransport(app=api.app)
+        results = {}
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            if "login" in scenarios:
+                async def login():
+                    username = random.choice(usernames)
+                    response = await client.post(
+                        "/auth/login",
+                        json={"username": username, "password": BENCH_PASSWORD, "hwid": f"hwid-{username}"},
+                    )
+                    return response.status_code == 200 and response.json()["success"]
+                results["login"] = await _run_fixed_concurrency(concurrency, requests, login)
+
+            if "download" in scenarios:
+                tokens = [
+                    api.create_token(username, 0, int(time.time()) + 3600)
+                    for username in usernames[:1000]
+                ]
+                # Первая загрузка наполняет кэш артефакта, её не меряем
+                await client.get("/client/download", headers={"Authorization": f"Bearer {tokens[0]}"})
+
+                async def download():
+                    token = random.choice(tokens)
+                    response = await client.get("/client/download", headers={"Authorization": f"Bearer {token}"})
+                    return response.status_code == 200
+                results["download"] = await _run_fixed_concurrency(concurrency, requests, download)
+
+            if "update" in scenarios:
+                versions = ["0.9.0", "1.0.0", "1.0.0-beta", "2.0.0"]
+
+                async def update_check():
+                    response = await client.get("/update/check", params={"version": random.choice(versions)})
+                    return response.status_code in (200, 304)
+                results["update"] = await _run_fixed_concurrency(concurrency, requests, update_check)
+        return results
+    finally:
+        await api.app.router.shutdown()
@@ -0,0 +1,44 @@
+import random
+import time
+
+from fastapi.security import HTTPAuthorizationCredentials
+
+import api
+import database
+from bench.seed import bench_username
+from bench.stats import Timer
+
+async def _measure(iterations: int, fn) -> dict:
+    timer = Timer()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn()
+        timer.latencies.append(time.perf_counter() - started)
+    return timer.result()
+
+async def run_micro(user_count: int, iterations: int) -> dict:
+    results = {}
+    hot = bench_username(0)
+
+    async def check_hot():
+        await database.check_subscription(hot)
+    results["check_subscription_cached"] = await _measure(iterations, check_hot)
+
+    async def check_cold():
+        database.clear_cache()
+        await database.check_subscription(bench_username(random.randrange(user_count)))
+    results["check_subscription_uncached"] = await _measure(iterations, check_cold)
+
+    # Полная выборка таблицы дорогая - несколько итераций достаточно
+    async def all_users():
+        await database.get_all_users()
+    results["get_all_users"] = await _measure(max(1, min(iterations, 2_000_000 // max(user_count, 1))), all_users)
+
+    credentials = HTTPAuthorizationCredentials(
+        scheme="Bearer", credentials=api.create_token(hot, 0, int(time.time()) + 3600)
+    )
+
+    async def verify():
+        api.verify_token(api.decode_token(credentials))
+    results["verify_token"] = await _measure(iterations, verify)
+    return results
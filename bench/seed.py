@@ -0,0 +1,51 @@
+import time
+from datetime import datetime, timedelta
+
+import database
+import passwords
+
+BENCH_PASSWORD = "benchpass"
+
+def bench_username(i: int) -> str:
+    return f"bench{i}"
+
+async def seed_users(count: int, active_ratio: float = 0.5):
+    """Создаёт count пользователей через database.create_user.
+
+    Файл БД переиспользуется между запусками, досоздаются только недостающие.
+    Хеш пароля считается один раз - bcrypt здесь не то, что мы меряем.
+    """
+    pool = await database.get_pool()
+    async with pool.reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'bench%'") as cursor:
+            existing = (await cursor.fetchone())[0]
+    if existing >= count:
+        return 0
+
+    password_hash = await passwords.hash_password(BENCH_PASSWORD)
+    started = time.perf_counter()
+    for i in range(existing, count):
+        await database.create_user(telegram_id=10_000_000 + i, username=bench_username(i), password_hash=password_hash)
+        if i and i % 50_000 == 0:
+            print(f"  seeded {i}/{count} ({time.perf_counter() - started:.0f}s)")
+
+    # Подписки выставляем одним UPDATE: каждый второй (по active_ratio) активен,
+    # у части подписка истекает в ближайшие дни
+    now = datetime.now()
+    active_until = now + timedelta(days=30)
+    expiring_until = now + timedelta(days=2)
+    step = max(1, round(1 / active_ratio)) if active_ratio > 0 else 0
+    async with pool.writer() as db:
+        if step:
+            await db.execute(
+                "UPDATE users SET subscription_end = ?, subscription_expires = ? "
+                "WHERE username LIKE 'bench%' AND id % ? = 0",
+                (active_until.isoformat(), int(active_until.timestamp()), step),
+            )
+            await db.execute(
+                "UPDATE users SET subscription_end = ?, subscription_expires = ? "
+                "WHERE username LIKE 'bench%' AND id % ? = 0",
+                (expiring_until.isoformat(), int(expiring_until.timestamp()), step * 10),
+            )
+    database.clear_cache()
+    return count - existing
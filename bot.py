@@ -1,26 +1,94 @@
 import asyncio
+import functools
+import logging
 import os
+import re
+import tempfile
+import time
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
-from passlib.context import CryptContext
 
+import admission
+import audit
+import broadcast
 import database
-from config import BOT_TOKEN
+import expiry
+import export
+import metrics
+import passwords
+import persistence
+import updates
+from config import (
+    BOT_TOKEN, API_WORKERS, BOT_CONCURRENT_UPDATES, BOT_HANDLER_TIMEOUT,
+    BOT_STATE_FLUSH_SECONDS, BOT_STATE_IDLE_SECONDS, BOT_STATE_RETENTION_DAYS,
+)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger(__name__)
 
 # States
 REGISTER_USERNAME, REGISTER_PASSWORD = range(2)
 ADMIN_GIVE_SUB_USER, ADMIN_GIVE_SUB_DAYS = range(2, 4)
 ADMIN_RESET_HWID_USER = 4
 ADMIN_BAN_USER = 5
+ADMIN_BROADCAST_TEXT = 6
+ADMIN_BULK_DAYS, ADMIN_BULK_USERS = range(7, 9)
+ADMIN_SEARCH = 9
 
 ADMIN_IDS = [int(os.getenv("ADMIN_ID", "7463401648"))]
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+def process_stats_header() -> str:
+    # Счётчики в памяти принадлежат процессу, который показывает статистику
+    if API_WORKERS > 1:
+        return (
+            f"⚠️ *Ниже - только процесс бота* (pid {os.getpid()}). "
+            f"У {API_WORKERS} воркеров API свои входы, bcrypt и кэш - см. их /metrics"
+        )
+    return f"*Процесс API и бота* (pid {os.getpid()}):"
+
+def stats_section(title: str, stats: dict, template: str) -> str:
+    # Пустой stats - компонент работает только в воркерах API
+    body = template.format(**stats) if stats else "не запущен в этом процессе"
+    return f"*{title}:*\n{body}"
+
+# Обработчики, которым нужно больше BOT_HANDLER_TIMEOUT (большие пачки в БД)
+HANDLER_TIMEOUTS = {
+    "admin_bulk_users": max(BOT_HANDLER_TIMEOUT, 120),
+    "export_users": max(BOT_HANDLER_TIMEOUT, 300),
+}
+
+def track(fn):
+    """Время обработчика: для кнопок - по префиксу callback_data, иначе по имени функции.
+
+    Обработчик, превысивший таймаут, отменяется: обновления этого чата
+    ждут предыдущее, и зависший обработчик не должен держать чат.
+    """
+    timeout = HANDLER_TIMEOUTS.get(fn.__name__, BOT_HANDLER_TIMEOUT)
+    
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.callback_query is not None and update.callback_query.data:
+            label = "callback:" + update.callback_query.data.split(":", 1)[0][:32]
+        else:
+            label = fn.__name__
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(fn(update, context), timeout)
+        except asyncio.TimeoutError:
+            metrics.BOT_HANDLER_TIMEOUTS.inc(label)
+            logger.warning("Handler %s timed out after %.0fs", label, timeout)
+            if update.effective_chat is not None:
+                await context.bot.send_message(update.effective_chat.id, "⏳ Сервер перегружен, попробуйте ещё раз")
+            # Состояние диалога не меняется
+            return None
+        finally:
+            metrics.BOT_LATENCY.observe(time.perf_counter() - started, label)
+    return wrapper
+
+@track
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -45,6 +113,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+@track
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -146,7 +215,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🎁 Выдать подписку", callback_data="admin_give_sub")],
             [InlineKeyboardButton("🔄 Сбросить HWID", callback_data="admin_reset_hwid")],
             [InlineKeyboardButton("📋 Список юзеров", callback_data="admin_list_users")],
+            [InlineKeyboardButton("🔎 Найти пользователя", callback_data="admin_search")],
             [InlineKeyboardButton("🚫 Забанить", callback_data="admin_ban")],
+            [InlineKeyboardButton("📦 Массовые операции", callback_data="admin_bulk")],
+            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton("🕵️ Неудачные входы", callback_data="admin_audit")],
+            [InlineKeyboardButton("📣 Рассылка", callback_data="admin_broadcast")],
             [InlineKeyboardButton("◀️ Назад", callback_data="back_main")],
         ]
         
@@ -180,18 +254,146 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ADMIN_RESET_HWID_USER
     
-    elif query.data == "admin_list_users":
+    elif query.data == "admin_list_users" or query.data.startswith("admin_users:"):
         if not is_admin(query.from_user.id):
             return ConversationHandler.END
         
-        users = await database.get_all_users()
-        if not users:
-            text = "📋 Пользователей нет"
+        # admin_users:<фильтр>:<направление>:<курсор>
+        if query.data == "admin_list_users":
+            filter_name, direction, cursor = "all", "n", 0
         else:
-            text = "📋 *Список пользователей:*\n\n"
-            for u in users[:20]:  # Максимум 20
-                sub_ok = "✅" if await database.check_subscription(u['username']) else "❌"
-                text += f"{sub_ok} `{u['username']}`\n"
+            _, filter_name, direction, cursor = query.data.split(":")
+            cursor = int(cursor)
+        
+        text, reply_markup = await render_users_page(filter_name, direction, cursor)
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+        return ConversationHandler.END
+    
+    elif query.data == "admin_search":
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        await query.edit_message_text(
+            "🔎 *Поиск пользователя*\n\n"
+            "Введите часть логина, Telegram ID или HWID:\n"
+            "/cancel - отмена",
+            parse_mode="Markdown"
+        )
+        return ADMIN_SEARCH
+    
+    elif query.data.startswith("admin_pick:"):
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        # admin_pick:<действие>:<id пользователя>
+        _, action, user_id = query.data.split(":")
+        user = await database.get_user_by_id(int(user_id))
+        if not user or action not in PICK_ACTIONS:
+            await query.edit_message_text("❌ Пользователь не найден")
+            return ConversationHandler.END
+        username = user['username']
+        
+        if action == "view":
+            text, reply_markup = await render_user_card(user)
+            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+            return ConversationHandler.END
+        if action == "give_sub":
+            context.user_data['admin_target_user'] = username
+            await query.edit_message_text(f"Пользователь: `{username}`\n\nВведите количество дней подписки:", parse_mode="Markdown")
+            return ADMIN_GIVE_SUB_DAYS
+        
+        # Бан и сброс HWID из списка - только после подтверждения
+        keyboard = [[
+            InlineKeyboardButton("✅ Подтвердить", callback_data=f"admin_confirm:{action}:{user['id']}"),
+            InlineKeyboardButton("❌ Отмена", callback_data=f"admin_pick:view:{user['id']}"),
+        ]]
+        await query.edit_message_text(
+            PICK_CONFIRM_TEXT[action].format(username=username),
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return ConversationHandler.END
+    
+    elif query.data.startswith("admin_confirm:"):
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        # admin_confirm:<действие>:<id пользователя>
+        _, action, user_id = query.data.split(":")
+        user = await database.get_user_by_id(int(user_id))
+        if not user or action not in PICK_CONFIRM_TEXT:
+            await query.edit_message_text("❌ Пользователь не найден")
+            return ConversationHandler.END
+        
+        done = reset_hwid_done if action == "reset_hwid" else ban_done
+        await query.edit_message_text(await done(user['username']), parse_mode="Markdown")
+        return ConversationHandler.END
+    
+    elif query.data == "admin_stats":
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        pw = passwords.stats()
+        ad = admission.stats()
+        uc = database.cache_stats()
+        au = audit.stats()
+        bc = broadcast.stats()
+        ex = expiry.stats()
+        up = updates.stats()
+        st = persistence.stats()
+        active_subs = await database.count_active_subscriptions()
+        expiring_subs = await database.count_active_subscriptions(expiring_within=3 * 86400)
+        sections = [
+            "📊 *Статистика*",
+            f"*Подписки:* активных {active_subs}, истекают за 3 дня: {expiring_subs}",
+            process_stats_header(),
+            "*bcrypt пул:*\n"
+            f"Потоков: {pw['workers']}, лимит очереди: {pw['max_queue']}\n"
+            f"В работе: {pw['in_flight']}, в очереди: {pw['queued']}\n"
+            f"Пик: {pw['peak_pending']}, выполнено: {pw['completed']}, отклонено: {pw['rejected']}",
+            stats_section(
+                "Допуск входов", ad,
+                "В работе: {in_flight}/{max_concurrent}, под лимитом IP: {tracked_ips}, логинов: {tracked_users}",
+            ),
+            "*Кэш пользователей:*\n"
+            f"Записей: {uc['size']}/{uc['maxsize']}\n"
+            f"Попаданий: {uc['hits']}, промахов: {uc['misses']}, вытеснено: {uc['evictions']}",
+            stats_section(
+                "Журнал входов", au,
+                "В очереди: {queued}, записано: {written}, отброшено: {dropped}, ошибок: {failed}",
+            ),
+            stats_section("Рассылки", bc, "Доставлено: {sent}, ошибок: {failed}, отложено: {retried}"),
+            stats_section("Напоминания о подписке", ex, "Отслеживается: {tracked}, отправлено: {sent}"),
+            stats_section(
+                "Обработка обновлений бота", up,
+                "В работе: {running}/{limit}, в очереди: {pending}, чатов: {chats}",
+            ),
+            stats_section(
+                "Состояния диалогов", st,
+                "В памяти: {loaded}, ждут записи: {staged}, выгружено: {evictions}",
+            ),
+        ]
+        text = "\n\n".join(sections)
+        
+        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
+    
+    elif query.data == "admin_audit":
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        since = int(time.time()) - 86400
+        rows = await database.get_login_failures(since)
+        if not rows:
+            text = "🕵️ За последние 24 часа неудачных входов нет"
+        else:
+            text = "🕵️ *Неудачные входы за 24 часа:*\n\n"
+            for r in rows:
+                text += (
+                    f"`{r['username']}` - {r['failures']} "
+                    f"(HWID mismatch: {r['hwid_mismatches']}, HWID: {r['hwids']}, IP: {r['ips']})\n"
+                )
         
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]
         await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -208,9 +410,126 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ADMIN_BAN_USER
     
+    elif query.data == "admin_bulk":
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        keyboard = [
+            [InlineKeyboardButton(label, callback_data=f"admin_bulk:{op}")]
+            for op, label in BULK_OPERATION_LABELS.items()
+        ]
+        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")])
+        await query.edit_message_text(
+            "📦 *Массовые операции*\n\n"
+            "Список логинов можно вставить текстом или прислать CSV-файлом.",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return ConversationHandler.END
+    
+    elif query.data.startswith("admin_bulk:"):
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        operation = query.data.split(":", 1)[1]
+        if operation not in BULK_OPERATION_LABELS:
+            return ConversationHandler.END
+        context.user_data['bulk_operation'] = operation
+        context.user_data.pop('bulk_days', None)
+        
+        if operation in ("extend", "set"):
+            await query.edit_message_text(
+                f"{BULK_OPERATION_LABELS[operation]}\n\nВведите количество дней:"
+            )
+            return ADMIN_BULK_DAYS
+        await query.edit_message_text(f"{BULK_OPERATION_LABELS[operation]}\n\n{BULK_USERS_PROMPT}", parse_mode="Markdown")
+        return ADMIN_BULK_USERS
+    
+    elif query.data == "admin_broadcast":
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        await query.edit_message_text(
+            "📣 *Рассылка*\n\n"
+            "Отправьте текст сообщения, форматирование сохранится.\n"
+            "/cancel - отмена",
+            parse_mode="Markdown"
+        )
+        return ADMIN_BROADCAST_TEXT
+    
+    elif query.data.startswith("broadcast_send:"):
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        text = context.user_data.pop('broadcast_text', None)
+        audience = query.data.split(":", 1)[1]
+        if not text or audience not in BROADCAST_AUDIENCES:
+            await query.edit_message_text("❌ Текст рассылки не найден, начните заново")
+            return ConversationHandler.END
+        
+        # Это же сообщение дальше показывает прогресс
+        created = await database.create_broadcast(text, audience, query.message.chat_id, query.message.message_id)
+        await query.edit_message_text(broadcast.progress_text(created), reply_markup=broadcast.progress_markup(created))
+        broadcast.wake()
+        return ConversationHandler.END
+    
+    elif query.data.startswith("broadcast_cancel:"):
+        if not is_admin(query.from_user.id):
+            return ConversationHandler.END
+        
+        cancelled = await database.cancel_broadcast(int(query.data.split(":", 1)[1]))
+        if cancelled is not None:
+            await query.edit_message_text(broadcast.progress_text(cancelled), reply_markup=broadcast.progress_markup(cancelled))
+        return ConversationHandler.END
+    
     return ConversationHandler.END
 
+USERS_PAGE_SIZE = 20
+USER_FILTER_LABELS = [
+    ("all", "Все"),
+    ("active", "✅ Активные"),
+    ("expired", "❌ Истекшие"),
+    ("banned", "🚫 Бан"),
+    ("hwid", "💻 HWID"),
+]
+
+async def render_users_page(filter_name: str, direction: str, cursor: int):
+    if filter_name not in database.USER_LIST_FILTERS:
+        filter_name = "all"
+    
+    if direction == "p":
+        users, has_newer, has_older = await database.list_users_page(filter_name, before_id=cursor, limit=USERS_PAGE_SIZE)
+    else:
+        users, has_newer, has_older = await database.list_users_page(filter_name, after_id=cursor or None, limit=USERS_PAGE_SIZE)
+    
+    if not users:
+        text = "📋 Пользователей нет"
+    else:
+        text = "📋 *Список пользователей:*\n\n"
+        for u in users:
+            sub_ok = "✅" if u['has_subscription'] else "❌"
+            banned = " 🚫" if not u['is_active'] else ""
+            text += f"{sub_ok} `{u['username']}`{banned}\n"
+    
+    filter_buttons = [
+        InlineKeyboardButton(("• " if name == filter_name else "") + label, callback_data=f"admin_users:{name}:n:0")
+        for name, label in USER_FILTER_LABELS
+    ]
+    keyboard = [filter_buttons[:3], filter_buttons[3:]]
+    
+    nav = []
+    if users and has_newer:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"admin_users:{filter_name}:p:{users[0]['id']}"))
+    if users and has_older:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"admin_users:{filter_name}:n:{users[-1]['id']}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")])
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
 # Регистрация
+@track
 async def register_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     
@@ -227,6 +546,7 @@ async def register_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введите пароль (минимум 6 символов):")
     return REGISTER_PASSWORD
 
+@track
 async def register_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = update.message.text
     
@@ -235,7 +555,11 @@ async def register_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return REGISTER_PASSWORD
     
     username = context.user_data['reg_username']
-    password_hash = pwd_context.hash(password)
+    try:
+        password_hash = await passwords.hash_password(password)
+    except passwords.PasswordPoolBusy:
+        await update.message.reply_text("⏳ Сервер перегружен, отправьте пароль ещё раз через пару секунд")
+        return REGISTER_PASSWORD
     
     try:
         await database.create_user(
@@ -256,19 +580,81 @@ async def register_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+# Админ: поиск пользователя
+SEARCH_LIMIT = 10
+# Действия из результатов поиска: view - карточка пользователя
+PICK_ACTIONS = ("view", "give_sub", "reset_hwid", "ban")
+PICK_CONFIRM_TEXT = {
+    "reset_hwid": "🔄 Сбросить HWID пользователя `{username}`?",
+    "ban": "🚫 Забанить пользователя `{username}`?",
+}
+
+def search_markup(users, action: str):
+    keyboard = []
+    for u in users:
+        sub_ok = "✅" if u['has_subscription'] else "❌"
+        banned = " 🚫" if not u['is_active'] else ""
+        keyboard.append([InlineKeyboardButton(f"{sub_ok} {u['username']}{banned}", callback_data=f"admin_pick:{action}:{u['id']}")])
+    keyboard.append([InlineKeyboardButton("◀️ Админ панель", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def reply_not_found(update: Update, query: str, action: str, retry: str = ""):
+    """Не найден точный логин: предлагает похожих пользователей кнопками."""
+    users = await database.search_users(query, limit=SEARCH_LIMIT, fuzzy=True)
+    if not users:
+        await update.message.reply_text(f"❌ Пользователь не найден{retry}")
+        return
+    await update.message.reply_text(
+        f"❌ Пользователь не найден. Возможно, нужен один из этих{retry}",
+        reply_markup=search_markup(users, action)
+    )
+
+async def render_user_card(user):
+    sub_status = "✅ Активна" if await database.check_subscription(user['username']) else "❌ Нет"
+    text = (
+        f"👤 *Пользователь* `{user['username']}`\n\n"
+        f"ID: {user['id']}, Telegram: `{user['telegram_id']}`\n"
+        f"Подписка: {sub_status}, до: {user['subscription_end'] or 'N/A'}\n"
+        f"HWID: `{user['hwid'] or 'не привязан'}`\n"
+        f"Статус: {'активен' if user['is_active'] else '🚫 забанен'}"
+    )
+    keyboard = [
+        [InlineKeyboardButton("🎁 Выдать подписку", callback_data=f"admin_pick:give_sub:{user['id']}")],
+        [InlineKeyboardButton("🔄 Сбросить HWID", callback_data=f"admin_pick:reset_hwid:{user['id']}")],
+        [InlineKeyboardButton("🚫 Забанить", callback_data=f"admin_pick:ban:{user['id']}")],
+        [InlineKeyboardButton("◀️ Админ панель", callback_data="admin_panel")],
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+@track
+async def admin_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    users = await database.search_users(update.message.text, limit=SEARCH_LIMIT)
+    if not users:
+        await update.message.reply_text("🔎 Ничего не найдено. Введите другой запрос или /cancel:")
+        return ADMIN_SEARCH
+    
+    await update.message.reply_text(
+        f"🔎 Найдено: {len(users)}{'+' if len(users) == SEARCH_LIMIT else ''}\n"
+        "Выберите пользователя или введите новый запрос:",
+        reply_markup=search_markup(users, "view")
+    )
+    return ADMIN_SEARCH
+
 # Админ: выдача подписки
+@track
 async def admin_give_sub_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     user = await database.get_user_by_username(username)
     
     if not user:
-        await update.message.reply_text("❌ Пользователь не найден. Попробуйте ещё раз:")
+        await reply_not_found(update, username, "give_sub", retry=" или введите логин ещё раз:")
         return ADMIN_GIVE_SUB_USER
     
     context.user_data['admin_target_user'] = username
     await update.message.reply_text(f"Пользователь: `{username}`\n\nВведите количество дней подписки:", parse_mode="Markdown")
     return ADMIN_GIVE_SUB_DAYS
 
+@track
 async def admin_give_sub_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         days = int(update.message.text.strip())
@@ -290,43 +676,256 @@ async def admin_give_sub_days(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ConversationHandler.END
 
 # Админ: сброс HWID
+@track
 async def admin_reset_hwid_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     user = await database.get_user_by_username(username)
     
     if not user:
-        await update.message.reply_text("❌ Пользователь не найден")
+        await reply_not_found(update, username, "reset_hwid")
         return ConversationHandler.END
     
-    await database.reset_hwid(username)
-    await update.message.reply_text(
-        f"✅ HWID сброшен для `{username}`\n\n/start - вернуться в меню",
-        parse_mode="Markdown"
-    )
+    await update.message.reply_text(await reset_hwid_done(username), parse_mode="Markdown")
     return ConversationHandler.END
 
+async def reset_hwid_done(username: str) -> str:
+    await database.reset_hwid(username)
+    return f"✅ HWID сброшен для `{username}`\n\n/start - вернуться в меню"
+
 # Админ: бан
+@track
 async def admin_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     user = await database.get_user_by_username(username)
     
     if not user:
-        await update.message.reply_text("❌ Пользователь не найден")
+        await reply_not_found(update, username, "ban")
         return ConversationHandler.END
     
+    await update.message.reply_text(await ban_done(username), parse_mode="Markdown")
+    return ConversationHandler.END
+
+async def ban_done(username: str) -> str:
     await database.ban_user(username)
+    return f"🚫 Пользователь `{username}` забанен\n\n/start - вернуться в меню"
+
+# Админ: массовые операции
+BULK_OPERATION_LABELS = {
+    "extend": "➕ Продлить подписку",
+    "set": "🎁 Выдать подписку (от сегодня)",
+    "ban": "🚫 Забанить",
+    "reset_hwid": "🔄 Сбросить HWID",
+}
+BULK_USERS_PROMPT = (
+    "Отправьте логины по одному в строке (или через запятую) либо CSV-файл.\n"
+    "Для подписки в строке можно указать своё число дней: `логин,дни`\n"
+    "/cancel - отмена"
+)
+BULK_MAX_USERS = 10000
+BULK_MAX_FILE_SIZE = 1024 * 1024
+BULK_SUMMARY_MISSING = 50
+
+def parse_bulk_targets(text: str, default_days):
+    """Строки "логин", "логин,дни" или несколько логинов через запятую/пробел.
+
+    Возвращает ([(username, days)], ошибочные строки). Заголовок CSV пропускается.
+    Для бана и сброса HWID (default_days is None) число в "логин,дни" игнорируется.
+    """
+    targets, errors = [], []
+    for line in text.splitlines():
+        tokens = [token.strip().strip('"') for token in re.split(r"[,;\t ]+", line.strip()) if token.strip()]
+        if not tokens or tokens[0].lower() in ("username", "login", "логин"):
+            continue
+        if len(tokens) == 2 and tokens[1].lstrip("-").isdigit():
+            if default_days is None:
+                targets.append((tokens[0], None))
+                continue
+            days = int(tokens[1])
+            if days <= 0:
+                errors.append(line.strip())
+                continue
+            targets.append((tokens[0], days))
+            continue
+        targets.extend((token, default_days) for token in tokens)
+    return targets, errors
+
+@track
+async def admin_bulk_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        days = int(update.message.text.strip())
+    except ValueError:
+        days = 0
+    if days <= 0:
+        await update.message.reply_text("❌ Введите положительное число")
+        return ADMIN_BULK_DAYS
+    
+    context.user_data['bulk_days'] = days
+    await update.message.reply_text(BULK_USERS_PROMPT, parse_mode="Markdown")
+    return ADMIN_BULK_USERS
+
+@track
+async def admin_bulk_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    operation = context.user_data.get('bulk_operation')
+    if operation not in BULK_OPERATION_LABELS:
+        return ConversationHandler.END
+    
+    document = update.message.document
+    if document is not None:
+        if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+            await update.message.reply_text("❌ Файл больше 1 МБ")
+            return ADMIN_BULK_USERS
+        data = await (await document.get_file()).download_as_bytearray()
+        text = bytes(data).decode("utf-8-sig", errors="replace")
+    else:
+        text = update.message.text
+    
+    targets, errors = parse_bulk_targets(text, context.user_data.get('bulk_days'))
+    if not targets:
+        await update.message.reply_text("❌ Логины не найдены, отправьте список ещё раз")
+        return ADMIN_BULK_USERS
+    if len(targets) > BULK_MAX_USERS:
+        await update.message.reply_text(f"❌ Не больше {BULK_MAX_USERS} логинов за раз")
+        return ADMIN_BULK_USERS
+    
+    updated, missing = await database.bulk_update_users(operation, targets)
+    context.user_data.pop('bulk_operation', None)
+    context.user_data.pop('bulk_days', None)
+    
+    text = f"{BULK_OPERATION_LABELS[operation]}\n\n✅ Выполнено: {len(updated)}"
+    if missing:
+        shown = ", ".join(missing[:BULK_SUMMARY_MISSING])
+        more = f" и ещё {len(missing) - BULK_SUMMARY_MISSING}" if len(missing) > BULK_SUMMARY_MISSING else ""
+        text += f"\n❌ Не найдены ({len(missing)}): {shown}{more}"
+    if errors:
+        text += f"\n⚠️ Пропущено строк с ошибками: {len(errors)}"
+    text += "\n\n/start - вернуться в меню"
+    await update.message.reply_text(text)
+    return ConversationHandler.END
+
+# Админ: рассылка
+BROADCAST_AUDIENCES = {
+    "all": "Всем",
+    "active": "С подпиской",
+}
+
+@track
+async def admin_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # text_html сохраняет жирный, ссылки и т.п.; рассылается с parse_mode=HTML
+    context.user_data['broadcast_text'] = update.message.text_html
+    
+    buttons = []
+    for audience, label in BROADCAST_AUDIENCES.items():
+        count = await database.count_broadcast_recipients(audience)
+        buttons.append([InlineKeyboardButton(f"✅ {label} ({count})", callback_data=f"broadcast_send:{audience}")])
+    buttons.append([InlineKeyboardButton("❌ Отмена", callback_data="admin_panel")])
+    
     await update.message.reply_text(
-        f"🚫 Пользователь `{username}` забанен\n\n/start - вернуться в меню",
-        parse_mode="Markdown"
+        "📣 Сообщение выше будет отправлено. Кому?",
+        reply_markup=InlineKeyboardMarkup(buttons)
     )
     return ConversationHandler.END
 
+# Админ: выгрузка пользователей
+EXPORT_USAGE = (
+    "Использование: /export [csv|ndjson] [audit] [since_id=<id>] [since=<ГГГГ-ММ-ДД или unix-время>]\n"
+    "since_id - только новые пользователи, since - изменённые с этой даты (включительно)"
+)
+# Лимит Telegram на отправку файлов ботом
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024
+
+def parse_export_args(args):
+    options = {"fmt": "csv", "with_audit": False, "since_id": None, "since_updated": None}
+    for arg in args:
+        name, _, value = arg.lower().partition("=")
+        if name in export.FORMATS and not value:
+            options["fmt"] = name
+        elif name == "audit" and not value:
+            options["with_audit"] = True
+        elif name == "since_id" and value.isdigit():
+            options["since_id"] = int(value)
+        elif name == "since" and value.isdigit():
+            options["since_updated"] = int(value)
+        elif name == "since":
+            options["since_updated"] = int(datetime.strptime(value, "%Y-%m-%d").timestamp())
+        else:
+            raise ValueError(arg)
+    return options
+
+@track
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    try:
+        options = parse_export_args(context.args)
+    except ValueError:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    
+    # Пачки пишутся во временный файл по мере чтения из БД; чтение
+    # прекращается, как только файл перерос лимит Telegram на документ
+    chunks = export.stream(**options)
+    with tempfile.TemporaryFile() as file:
+        try:
+            async for chunk in chunks:
+                file.write(chunk)
+                if file.tell() > EXPORT_MAX_FILE_SIZE:
+                    await update.message.reply_text(
+                        f"❌ Выгрузка больше лимита Telegram ({EXPORT_MAX_FILE_SIZE // (1024 * 1024)} МБ).\n"
+                        "Используйте since_id/since или API /admin/export"
+                    )
+                    return
+        finally:
+            await chunks.aclose()
+        file.seek(0)
+        await update.message.reply_document(
+            file, filename=f"users-{datetime.now().strftime('%Y%m%d-%H%M')}.{options['fmt']}"
+        )
+
+@track
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Отменено. /start - вернуться в меню")
     return ConversationHandler.END
 
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+async def evict_idle_state(context: ContextTypes.DEFAULT_TYPE):
+    persistence.persistence.evict_idle(context.application)
+
+def start_background(application: Application):
+    broadcast.start(application.bot)
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(
+            evict_idle_state, interval=BOT_STATE_IDLE_SECONDS / 4, first=BOT_STATE_IDLE_SECONDS / 4
+        )
+
+async def post_init(application: Application):
+    await database.init_db()
+    start_background(application)
+    await expiry.start(application)
+
+async def post_stop(application: Application):
+    # Бот ещё инициализирован: рассыльщик не оборвёт запрос посреди shutdown
+    expiry.stop()
+    await broadcast.stop()
+
+async def post_shutdown(application: Application):
+    await database.close_db()
+
+def build_application(standalone: bool = True, webhook: bool = False) -> Application:
+    """standalone - бот в своём процессе и сам открывает/закрывает БД;
+    иначе он встроен в FastAPI и использует пул, открытый API."""
+    # Медленный обработчик (bcrypt, большая выборка) не задерживает другие чаты
+    builder = Application.builder().token(BOT_TOKEN).concurrent_updates(updates.create(BOT_CONCURRENT_UPDATES))
+    # Незаконченные регистрации и админские диалоги переживают перезапуск
+    builder = builder.persistence(persistence.create(
+        update_interval=BOT_STATE_FLUSH_SECONDS,
+        idle_seconds=BOT_STATE_IDLE_SECONDS,
+        retention_seconds=BOT_STATE_RETENTION_DAYS * 86400,
+    ))
+    if standalone:
+        builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if webhook:
+        # Обновления приходят через маршрут FastAPI прямо в update_queue
+        builder = builder.updater(None)
+    app = builder.build()
     
     # Главный обработчик диалогов
     conv_handler = ConversationHandler(
@@ -336,20 +935,58 @@ def main():
         states={
             REGISTER_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_username)],
             REGISTER_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_password)],
-            ADMIN_GIVE_SUB_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_give_sub_user)],
+            # Кнопки с найденными пользователями работают, пока диалог ждёт ввода
+            ADMIN_GIVE_SUB_USER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_give_sub_user),
+                CallbackQueryHandler(button_handler),
+            ],
             ADMIN_GIVE_SUB_DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_give_sub_days)],
             ADMIN_RESET_HWID_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_reset_hwid_user)],
             ADMIN_BAN_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_ban_user)],
+            ADMIN_BULK_DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_bulk_days)],
+            ADMIN_BULK_USERS: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, admin_bulk_users)],
+            ADMIN_BROADCAST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_text)],
+            ADMIN_SEARCH: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_search_query),
+                CallbackQueryHandler(button_handler),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel), CommandHandler("start", start)],
+        name="main",
+        persistent=True,
+        conversation_timeout=BOT_STATE_IDLE_SECONDS,
     )
     
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("export", export_users))
     app.add_handler(conv_handler)
-    
+    return app
+
+async def start_embedded(app: Application, webhook_url: str = "", webhook_secret: str = ""):
+    # Запуск на уже работающем event loop (внутри lifespan FastAPI)
+    await app.initialize()
+    await app.start()
+    start_background(app)
+    await expiry.start(app)
+    if webhook_url:
+        await app.bot.set_webhook(webhook_url, secret_token=webhook_secret or None)
+    else:
+        await app.updater.start_polling()
+    logger.info("Bot started (%s)", "webhook" if webhook_url else "polling")
+
+async def stop_embedded(app: Application):
+    expiry.stop()
+    await broadcast.stop()
+    if app.updater is not None and app.updater.running:
+        await app.updater.stop()
+    if app.running:
+        await app.stop()
+    await app.shutdown()
+
+def main():
+    app = build_application()
     print("Bot started!")
     app.run_polling()
 
 if __name__ == "__main__":
-    asyncio.run(database.init_db())
     main()
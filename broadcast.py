@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import database
+import metrics
+from config import (
+    BROADCAST_RATE, BROADCAST_BURST, BROADCAST_CHAT_INTERVAL, BROADCAST_BATCH_SIZE,
+    BROADCAST_MAX_ATTEMPTS, BROADCAST_RETRY_BASE, BROADCAST_PROGRESS_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Не больше rate отправок в секунду с запасом burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # Telegram ответил RetryAfter: flood-лимит общий на бота
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class ChatLimiter:
+    """Минимальный интервал между сообщениями в один чат (ограниченный словарь)."""
+
+    def __init__(self, interval: float, maxsize: int = 10000):
+        self.interval = interval
+        self.maxsize = maxsize
+        self._next = OrderedDict()
+
+    def reserve(self, chat_id: int) -> float:
+        """Резервирует слот; возвращает, сколько секунд ещё ждать (0 - можно слать)."""
+        now = time.monotonic()
+        ready_at = self._next.get(chat_id, 0.0)
+        if ready_at > now:
+            return ready_at - now
+        self._next[chat_id] = now + self.interval
+        self._next.move_to_end(chat_id)
+        while len(self._next) > self.maxsize:
+            self._next.popitem(last=False)
+        return 0.0
+
+def progress_text(broadcast) -> str:
+    status = {
+        "sending": "отправляется",
+        "done": "завершена",
+        "cancelled": "остановлена",
+    }.get(broadcast["status"], broadcast["status"])
+    done = broadcast["sent"] + broadcast["failed"]
+    percent = done * 100 // broadcast["total"] if broadcast["total"] else 100
+    return (
+        f"📣 Рассылка #{broadcast['id']}: {status}\n\n"
+        f"Обработано: {done}/{broadcast['total']} ({percent}%)\n"
+        f"Доставлено: {broadcast['sent']}, ошибок: {broadcast['failed']}"
+    )
+
+def progress_markup(broadcast):
+    if broadcast["status"] != "sending":
+        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Админ панель", callback_data="admin_panel")]])
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("⛔ Остановить", callback_data=f"broadcast_cancel:{broadcast['id']}")
+    ]])
+
+class Broadcaster:
+    """Отправка очереди broadcast_queue с учётом лимитов Telegram.
+
+    Получатели читаются из БД пачками по batch_size, итоги пачки пишутся
+    одной транзакцией. Временные ошибки откладывают сообщение с
+    экспоненциальной задержкой, после max_attempts оно считается ошибкой.
+    Прогресс обновляется правкой сообщения админа не чаще раза в
+    progress_seconds.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+        self.chats = ChatLimiter(BROADCAST_CHAT_INTERVAL)
+        self._wake = asyncio.Event()
+        self._task = None
+        self._reported = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                rows = await database.get_due_broadcast_messages(BROADCAST_BATCH_SIZE)
+                if rows:
+                    await self._send_batch(rows)
+                    continue
+                next_at = await database.next_broadcast_attempt()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Broadcast batch failed", exc_info=True)
+                next_at = time.time() + 5
+            timeout = None if next_at is None else max(0.0, next_at - time.time())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_batch(self, rows):
+        sent, failed, retry = [], [], []
+        tasks = []
+        for row in rows:
+            key = (row["broadcast_id"], row["chat_id"])
+            delay = self.chats.reserve(row["chat_id"])
+            if delay:
+                retry.append((row["attempts"], math.ceil(time.time() + delay), *key))
+                continue
+            await self.bucket.acquire()
+            tasks.append(asyncio.create_task(self._send(row)))
+
+        for outcome, key, attempts, next_at in await asyncio.gather(*tasks):
+            if outcome == "sent":
+                sent.append(key)
+            elif outcome == "failed":
+                failed.append(key)
+            else:
+                retry.append((attempts, next_at, *key))
+
+        self.sent += len(sent)
+        self.failed += len(failed)
+        self.retried += len(retry)
+        broadcasts = await database.finish_broadcast_batch(sent, failed, retry)
+        await self._report(broadcasts)
+
+    async def _send(self, row):
+        key = (row["broadcast_id"], row["chat_id"])
+        attempts = row["attempts"]
+        try:
+            await self.bot.send_message(row["chat_id"], row["text"], parse_mode=ParseMode.HTML)
+            return "sent", key, attempts, None
+        except RetryAfter as e:
+            # Не считается попыткой: сообщение просто ждёт снятия лимита
+            self.bucket.pause(e.retry_after)
+            return "retry", key, attempts, math.ceil(time.time() + e.retry_after)
+        except (Forbidden, BadRequest):
+            # Бот заблокирован, чат удалён и т.п. - повтор не поможет
+            return "failed", key, attempts, None
+        except Exception:
+            logger.debug("Broadcast to %s failed", row["chat_id"], exc_info=True)
+        attempts += 1
+        if attempts >= BROADCAST_MAX_ATTEMPTS:
+            return "failed", key, attempts, None
+        return "retry", key, attempts, math.ceil(time.time() + BROADCAST_RETRY_BASE * 2 ** (attempts - 1))
+
+    async def _report(self, broadcasts):
+        now = time.monotonic()
+        for broadcast in broadcasts:
+            finished = broadcast["status"] != "sending"
+            if not finished and now - self._reported.get(broadcast["id"], 0.0) < BROADCAST_PROGRESS_SECONDS:
+                continue
+            self._reported[broadcast["id"]] = now
+            if finished:
+                self._reported.pop(broadcast["id"], None)
+            await edit_progress(self.bot, broadcast)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "retried": self.retried}
+
+async def edit_progress(bot: Bot, broadcast):
+    if not broadcast["admin_chat_id"] or not broadcast["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(
+            progress_text(broadcast),
+            chat_id=broadcast["admin_chat_id"],
+            message_id=broadcast["progress_message_id"],
+            reply_markup=progress_markup(broadcast),
+        )
+    except TelegramError:
+        # "message is not modified", удалённое сообщение - прогресс не критичен
+        logger.debug("Failed to update broadcast #%s progress", broadcast["id"], exc_info=True)
+
+broadcaster: Broadcaster = None
+
+def start(bot: Bot):
+    global broadcaster
+    broadcaster = Broadcaster(bot)
+    broadcaster.start()
+
+async def stop():
+    global broadcaster
+    if broadcaster is not None:
+        await broadcaster.stop()
+        broadcaster = None
+
+def wake():
+    if broadcaster is not None:
+        broadcaster.wake()
+
+async def acquire():
+    """Слот общего лимита бота для сообщений вне рассылок (напоминания и т.п.)."""
+    if broadcaster is not None:
+        await broadcaster.bucket.acquire()
+
+def stats() -> dict:
+    """Пусто, если рассылки не запущены в этом процессе."""
+    return broadcaster.stats() if broadcaster is not None else {}
+
+metrics.register_stats("matrix_broadcast", "Broadcast messages processed by this process", stats)
@@ -3,10 +3,39 @@ import os
 # Telegram Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8466010858:AAEN7z_DZjD4x-9VuHn9f6pJgFpKX1Kbt4Q")
 
+# Бот внутри процесса API (один event loop). Webhook, если задан BOT_WEBHOOK_URL
+# (публичный адрес сервиса, путь /telegram/webhook добавляется автоматически),
+# иначе long polling
+BOT_ENABLED = os.getenv("BOT_ENABLED", "1") == "1"
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+# Обновления разных чатов обрабатываются параллельно (до BOT_CONCURRENT_UPDATES),
+# одного чата - по порядку; обработчик дольше BOT_HANDLER_TIMEOUT секунд прерывается
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", 32))
+BOT_HANDLER_TIMEOUT = float(os.getenv("BOT_HANDLER_TIMEOUT", 30))
+# Состояние диалогов и user_data в БД: запись пачкой раз в BOT_STATE_FLUSH_SECONDS,
+# диалог без ответа дольше BOT_STATE_IDLE_SECONDS завершается, а данные
+# пользователя выгружаются из памяти; в БД хранятся BOT_STATE_RETENTION_DAYS
+BOT_STATE_FLUSH_SECONDS = float(os.getenv("BOT_STATE_FLUSH_SECONDS", 5))
+BOT_STATE_IDLE_SECONDS = int(os.getenv("BOT_STATE_IDLE_SECONDS", 3600))
+BOT_STATE_RETENTION_DAYS = int(os.getenv("BOT_STATE_RETENTION_DAYS", 7))
+
 # API
 API_HOST = "0.0.0.0"
 API_PORT = int(os.getenv("PORT", 8000))  # Railway даёт свой порт
+# Bearer-токен для /metrics ("" - без авторизации)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Bearer-токен для выгрузки пользователей /admin/export ("" - выгрузка отключена)
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# Больше одного воркера: API в N процессах, бот - в отдельном процессе (polling)
+API_WORKERS = int(os.getenv("API_WORKERS", 1))
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+# Срок access-токена: 24 часа, пока лоадеры не умеют /auth/refresh (короткий - только вместе с ним)
+ACCESS_TOKEN_TTL_MINUTES = int(os.getenv("ACCESS_TOKEN_TTL_MINUTES", 24 * 60))
+REFRESH_TOKEN_TTL_DAYS = int(os.getenv("REFRESH_TOKEN_TTL_DAYS", 30))
+# Сколько хранить обменянный refresh-токен: его повторное предъявление в это время отзывает семейство
+REFRESH_REUSE_WINDOW_HOURS = int(os.getenv("REFRESH_REUSE_WINDOW_HOURS", 24))
 
 # Client JAR URL
 CLIENT_JAR_URL = os.getenv("CLIENT_JAR_URL", "https://github.com/arsenrachkov-blip/matirx-files/releases/download/v1.0/thunderhack-1.7.jar")
@@ -15,6 +44,76 @@ CLIENT_JAR_URL = os.getenv("CLIENT_JAR_URL", "https://github.com/arsenrachkov-bl
 LOADER_VERSION = "1.0.0"
 LOADER_DOWNLOAD_URL = os.getenv("LOADER_DOWNLOAD_URL", "https://your-cloud-storage.com/MatrixLoader.exe")
 LOADER_CHANGELOG = "Исправления и улучшения"
+# Манифест каналов (stable/beta), перечитывается при изменении файла.
+# Если файла нет, канал stable берётся из LOADER_* выше
+RELEASE_MANIFEST_PATH = os.getenv("RELEASE_MANIFEST_PATH", "releases.json")
+RELEASE_MANIFEST_CHECK_SECONDS = float(os.getenv("RELEASE_MANIFEST_CHECK_SECONDS", 5))
+UPDATE_CHECK_MAX_AGE = int(os.getenv("UPDATE_CHECK_MAX_AGE", 60))
 
 # Database
-DATABASE_PATH = "delta.db"
+DATABASE_PATH = os.getenv("DATABASE_PATH", "delta.db")
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", 4))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", 128))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+# Как часто проверять изменения от других процессов (0 - не проверять)
+DB_CHANGE_WATCH_MS = int(os.getenv("DB_CHANGE_WATCH_MS", 500))
+DB_CHANGE_LOG_RETENTION = int(os.getenv("DB_CHANGE_LOG_RETENTION", 3600))
+
+# Passwords (bcrypt)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 2))
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", 32))
+
+# Upstream HTTP (скачивание JAR)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_KEEPALIVE_CONNECTIONS", 20))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+
+# Локальный кэш JAR ("" - отключить и проксировать апстрим напрямую)
+ARTIFACT_CACHE_DIR = os.getenv("ARTIFACT_CACHE_DIR", "artifacts")
+ARTIFACT_REVALIDATE_SECONDS = float(os.getenv("ARTIFACT_REVALIDATE_SECONDS", 300))
+# Сколько версий JAR хранить; от каждой строится дельта к текущей (/client/delta)
+ARTIFACT_KEEP_VERSIONS = int(os.getenv("ARTIFACT_KEEP_VERSIONS", 5))
+
+# Кэш пользователей в памяти процесса
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+# Журнал попыток входа
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_MS = int(os.getenv("AUDIT_FLUSH_MS", 250))
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", 30))
+# Брать IP клиента из X-Forwarded-For (включать только за доверенным прокси, например Railway).
+# Каждый прокси дописывает адрес в конец, поэтому клиент - TRUSTED_PROXY_HOPS-я запись справа
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "0") == "1"
+TRUSTED_PROXY_HOPS = max(1, int(os.getenv("TRUSTED_PROXY_HOPS", 1)))
+
+# Допуск к /auth/login (до БД и bcrypt), сверх лимитов - 429 с Retry-After.
+# С одного IP - LOGIN_IP_PER_MINUTE попыток в минуту (запас LOGIN_IP_BURST),
+# на логин - LOGIN_USER_PER_MINUTE неудачных; 0 - без лимита.
+# Без TRUST_PROXY_HEADERS за прокси у всех клиентов один адрес (самого прокси),
+# поэтому по умолчанию лимит на IP включён, только если адрес клиента известен
+LOGIN_IP_PER_MINUTE = float(os.getenv("LOGIN_IP_PER_MINUTE", 20 if TRUST_PROXY_HEADERS else 0))
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", 10))
+LOGIN_USER_PER_MINUTE = float(os.getenv("LOGIN_USER_PER_MINUTE", 5))
+LOGIN_USER_BURST = int(os.getenv("LOGIN_USER_BURST", 5))
+# Одновременных проверок пароля; по умолчанию - сколько вмещает пул bcrypt
+LOGIN_MAX_CONCURRENT = int(os.getenv("LOGIN_MAX_CONCURRENT", PASSWORD_WORKERS + PASSWORD_MAX_QUEUE))
+# Сколько IP и логинов помнит каждый лимитер
+LOGIN_LIMITER_KEYS = int(os.getenv("LOGIN_LIMITER_KEYS", 100000))
+
+# Рассылки: лимиты Telegram - около 30 сообщений/с на бота и 1/с в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", 5))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", 1.0))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 100))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", 5))
+BROADCAST_RETRY_BASE = float(os.getenv("BROADCAST_RETRY_BASE", 5))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", 3))
+
+# Напоминания об окончании подписки (планировщик в процессе бота)
+EXPIRY_NOTICE_BEFORE = int(os.getenv("EXPIRY_NOTICE_BEFORE", 3 * 86400))
+# Подписки, истёкшие за это время до запуска, тоже получают напоминание
+EXPIRY_CATCHUP_SECONDS = int(os.getenv("EXPIRY_CATCHUP_SECONDS", 86400))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 100))
@@ -1,88 +1,1108 @@
-import aiosqlite
+import asyncio
+import logging
+import time
 from datetime import datetime
-from config import DATABASE_PATH
 
+import metrics
+import sessions
+from cache import TTLCache, MISSING
+from db_pool import ConnectionPool
+from config import (
+    DATABASE_PATH, DB_POOL_READERS, DB_CACHED_STATEMENTS, DB_BUSY_TIMEOUT_MS,
+    USER_CACHE_SIZE, USER_CACHE_TTL, DB_CHANGE_WATCH_MS, DB_CHANGE_LOG_RETENTION,
+    REFRESH_REUSE_WINDOW_HOURS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Один пул на event loop: соединения aiosqlite и примитивы asyncio
+# нельзя делить между разными циклами событий
+_pools = {}
+_watchers = {}
+# Циклы, в которых init_db уже выполнен (его вызывают и API, и бот)
+_ready = set()
+
+async def get_pool() -> ConnectionPool:
+    loop = asyncio.get_running_loop()
+    task = _pools.get(loop)
+    if task is None:
+        task = loop.create_task(_open_pool())
+        _pools[loop] = task
+    if task.done():
+        return task.result()
+    return await asyncio.shield(task)
+
+async def _open_pool() -> ConnectionPool:
+    pool = ConnectionPool(
+        DATABASE_PATH,
+        readers=DB_POOL_READERS,
+        cached_statements=DB_CACHED_STATEMENTS,
+        busy_timeout_ms=DB_BUSY_TIMEOUT_MS,
+    )
+    try:
+        await pool.open()
+    except BaseException:
+        _pools.pop(asyncio.get_running_loop(), None)
+        await pool.close()
+        raise
+    return pool
+
+async def close_db():
+    loop = asyncio.get_running_loop()
+    _ready.discard(loop)
+    watcher = _watchers.pop(loop, None)
+    if watcher is not None:
+        watcher.cancel()
+        try:
+            await watcher
+        except asyncio.CancelledError:
+            pass
+    task = _pools.pop(loop, None)
+    if task is None:
+        return
+    pool = await task
+    await pool.close()
+
+# Строки users по username. telegram_id -> username не меняется после
+# регистрации, поэтому индекс по telegram_id хранит только имя.
+_users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_usernames_by_telegram_id = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# Увеличивается при каждой инвалидации: чтение, начатое до записи,
+# не должно положить в кэш устаревшую строку
+_cache_generation = 0
+
+def _cache_user(user, generation: int):
+    if user is None or generation != _cache_generation:
+        return
+    _users.set(user['username'], user)
+    if user['telegram_id'] is not None:
+        _usernames_by_telegram_id.set(user['telegram_id'], user['username'])
+
+def invalidate_user(username: str):
+    global _cache_generation
+    _cache_generation += 1
+    _users.pop(username)
+
+def clear_cache():
+    global _cache_generation
+    _cache_generation += 1
+    _users.clear()
+
+def cache_stats() -> dict:
+    return _users.stats()
+
+# Подписчики на изменение срока подписки: fn(username, subscription_expires).
+# Вызываются после коммита в том же процессе (планировщик напоминаний бота)
+_subscription_listeners = []
+
+def add_subscription_listener(fn):
+    _subscription_listeners.append(fn)
+
+def remove_subscription_listener(fn):
+    if fn in _subscription_listeners:
+        _subscription_listeners.remove(fn)
+
+def _notify_subscription(username: str, expires):
+    for listener in _subscription_listeners:
+        try:
+            listener(username, expires)
+        except Exception:
+            logger.warning("Subscription listener failed", exc_info=True)
+
+metrics.register_stats("matrix_user_cache", "In-process user cache counters", _users.stats)
+
+async def _migrate_create_users(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            hwid TEXT,
+            subscription_end DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1
+        )
+    ''')
+
+async def _migrate_subscription_expires(db):
+    # Срок подписки в unix-времени: сравнение и индекс прямо в SQL
+    await db.execute('ALTER TABLE users ADD COLUMN subscription_expires INTEGER')
+    async with db.execute(
+        'SELECT id, subscription_end FROM users WHERE subscription_end IS NOT NULL'
+    ) as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany(
+        'UPDATE users SET subscription_expires = ? WHERE id = ?',
+        [(int(datetime.fromisoformat(row['subscription_end']).timestamp()), row['id']) for row in rows]
+    )
+    await db.execute('CREATE INDEX idx_users_subscription_expires ON users (subscription_expires)')
+
+async def _migrate_sessions(db):
+    # Поколение токенов: бан или сброс HWID увеличивает его и отзывает все выданные токены
+    await db.execute('ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0')
+    await db.execute('''
+        CREATE TABLE revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('CREATE INDEX idx_revoked_tokens_expires_at ON revoked_tokens (expires_at)')
+
+async def _migrate_refresh_tokens(db):
+    # Храним только sha256 от refresh-токена; used=1 - токен уже обменян (ротация)
+    await db.execute('''
+        CREATE TABLE refresh_tokens (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            hwid TEXT NOT NULL,
+            family TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute('CREATE INDEX idx_refresh_tokens_family ON refresh_tokens (family)')
+    await db.execute('CREATE INDEX idx_refresh_tokens_expires_at ON refresh_tokens (expires_at)')
+
+async def _migrate_change_log(db):
+    # Журнал изменений для согласования кэшей между процессами (API воркеры + бот).
+    # Заполняется триггерами, поэтому его не обойдёт ни одна запись в users.
+    await db.execute('''
+        CREATE TABLE change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_insert_log AFTER INSERT ON users BEGIN
+            INSERT INTO change_log (kind, key) VALUES ('user', NEW.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_update_log AFTER UPDATE ON users BEGIN
+            INSERT INTO change_log (kind, key) VALUES ('user', NEW.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_delete_log AFTER DELETE ON users BEGIN
+            INSERT INTO change_log (kind, key) VALUES ('user', OLD.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_revoked_tokens_log AFTER INSERT ON revoked_tokens BEGIN
+            INSERT INTO change_log (kind, key) VALUES ('jti', NEW.jti);
+        END
+    ''')
+    await db.execute('CREATE INDEX idx_change_log_changed_at ON change_log (changed_at)')
+
+async def _migrate_login_audit(db):
+    await db.execute('''
+        CREATE TABLE login_audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            hwid TEXT,
+            ip TEXT,
+            result TEXT NOT NULL,
+            latency_ms REAL
+        )
+    ''')
+    # Частичный индекс только по неудачным попыткам: его и читает админка
+    await db.execute(
+        "CREATE INDEX idx_login_audit_failures ON login_audit (created_at, username) WHERE result != 'ok'"
+    )
+    await db.execute('CREATE INDEX idx_login_audit_username ON login_audit (username, created_at)')
+
+async def _migrate_broadcasts(db):
+    # Рассылки и их очередь получателей; строка очереди удаляется после
+    # доставки или окончательной ошибки
+    await db.execute('''
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'sending',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE broadcast_queue (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('CREATE INDEX idx_broadcast_queue_due ON broadcast_queue (next_attempt_at)')
+
+async def _migrate_expiry_notices(db):
+    # Отправленные напоминания об окончании подписки: не повторять после перезапуска
+    await db.execute('''
+        CREATE TABLE expiry_notices (
+            username TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            expires INTEGER NOT NULL,
+            sent_at INTEGER NOT NULL,
+            PRIMARY KEY (username, kind, expires)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('CREATE INDEX idx_expiry_notices_sent_at ON expiry_notices (sent_at)')
+
+async def _migrate_bot_state(db):
+    # Состояние бота (user_data, состояния диалогов) для SQLitePersistence.
+    # kind: 'user' или 'conv:<имя диалога>', key - id пользователя или ключ диалога (JSON)
+    await db.execute('''
+        CREATE TABLE bot_state (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('CREATE INDEX idx_bot_state_updated_at ON bot_state (kind, updated_at)')
+
+async def _migrate_user_search(db):
+    # Поиск логина по подстроке для админки: триграммный FTS5 поверх users
+    # (external content - сами логины не дублируются), обновляется триггерами
+    await db.execute(
+        "CREATE VIRTUAL TABLE users_fts USING fts5(username, content='users', content_rowid='id', tokenize='trigram')"
+    )
+    await db.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    await db.execute('''
+        CREATE TRIGGER trg_users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username) VALUES (NEW.id, NEW.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_fts_update AFTER UPDATE OF username ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+            INSERT INTO users_fts (rowid, username) VALUES (NEW.id, NEW.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+        END
+    ''')
+    await db.execute('CREATE INDEX idx_users_hwid ON users (hwid) WHERE hwid IS NOT NULL')
+
+async def _migrate_users_updated_at(db):
+    # Время последнего изменения пользователя для инкрементальной выгрузки.
+    # Ставится теми же триггерами, что пишут change_log: с recursive_triggers
+    # = OFF внутренний UPDATE не запускает триггер повторно, а на INSERT
+    # (updated_at ещё NULL) триггер обновления отключён условием WHEN
+    await db.execute('ALTER TABLE users ADD COLUMN updated_at INTEGER')
+    await db.execute(
+        "UPDATE users SET updated_at = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))"
+    )
+    await db.execute('CREATE INDEX idx_users_updated_at ON users (updated_at, id)')
+    await db.execute('DROP TRIGGER trg_users_insert_log')
+    await db.execute('DROP TRIGGER trg_users_update_log')
+    await db.execute('''
+        CREATE TRIGGER trg_users_insert_log AFTER INSERT ON users BEGIN
+            UPDATE users SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = NEW.id;
+            INSERT INTO change_log (kind, key) VALUES ('user', NEW.username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER trg_users_update_log AFTER UPDATE ON users WHEN OLD.updated_at IS NOT NULL BEGIN
+            UPDATE users SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = NEW.id;
+            INSERT INTO change_log (kind, key) VALUES ('user', NEW.username);
+        END
+    ''')
+
+# Порядок менять нельзя: номер миграции = индекс + 1 (PRAGMA user_version)
+MIGRATIONS = [
+    _migrate_create_users,
+    _migrate_subscription_expires,
+    _migrate_sessions,
+    _migrate_refresh_tokens,
+    _migrate_change_log,
+    _migrate_login_audit,
+    _migrate_broadcasts,
+    _migrate_expiry_notices,
+    _migrate_bot_state,
+    _migrate_user_search,
+    _migrate_users_updated_at,
+]
+
+@metrics.timed(metrics.DB_LATENCY, "init_db")
 async def init_db():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                hwid TEXT,
-                subscription_end DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT 1
+    loop = asyncio.get_running_loop()
+    if loop in _ready:
+        return
+    pool = await get_pool()
+    async with pool.writer() as db:
+        while True:
+            # BEGIN IMMEDIATE: несколько процессов не применят одну миграцию дважды
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute('PRAGMA user_version') as cursor:
+                version = (await cursor.fetchone())[0]
+            if version >= len(MIGRATIONS):
+                await db.commit()
+                break
+            await MIGRATIONS[version](db)
+            await db.execute(f'PRAGMA user_version = {version + 1}')
+            await db.commit()
+    await prune_expired_tokens()
+    await _load_sessions()
+    _ready.add(loop)
+    
+    if DB_CHANGE_WATCH_MS > 0 and loop not in _watchers:
+        _watchers[loop] = loop.create_task(_watch_changes(pool))
+
+async def _apply_changes(db, rows):
+    usernames = {row['key'] for row in rows if row['kind'] == 'user'}
+    jtis = [row['key'] for row in rows if row['kind'] == 'jti']
+    for username in usernames:
+        invalidate_user(username)
+    
+    if usernames:
+        names = list(usernames)
+        placeholders = ','.join('?' * len(names))
+        async with db.execute(
+            f'SELECT username, token_generation FROM users WHERE username IN ({placeholders})', names
+        ) as cursor:
+            for row in await cursor.fetchall():
+                sessions.set_generation(row[0], row[1])
+    if jtis:
+        placeholders = ','.join('?' * len(jtis))
+        async with db.execute(
+            f'SELECT jti, expires_at FROM revoked_tokens WHERE jti IN ({placeholders})', jtis
+        ) as cursor:
+            for row in await cursor.fetchall():
+                sessions.revoke(row[0], row[1])
+
+async def _poll_changes(pool: ConnectionPool, db, last_seq: int, data_version: int):
+    async with db.execute('PRAGMA data_version') as cursor:
+        version = (await cursor.fetchone())[0]
+    if version == data_version:
+        return last_seq, data_version
+    
+    async with db.execute(
+        'SELECT seq, kind, key FROM change_log WHERE seq > ? ORDER BY seq', (last_seq,)
+    ) as cursor:
+        rows = await cursor.fetchall()
+    if not rows:
+        return last_seq, version
+    if rows[0]['seq'] > last_seq + 1:
+        # Нужные записи журнала уже удалены - сбрасываем всё целиком
+        clear_cache()
+        await _load_sessions()
+    else:
+        await _apply_changes(db, rows)
+    
+    # Примерно раз в 1000 изменений удаляем записи старше DB_CHANGE_LOG_RETENTION
+    if rows[-1]['seq'] // 1000 != last_seq // 1000:
+        async with pool.writer() as writer:
+            await writer.execute(
+                'DELETE FROM change_log WHERE changed_at < ?',
+                (int(time.time()) - DB_CHANGE_LOG_RETENTION,)
             )
-        ''')
-        await db.commit()
+    return rows[-1]['seq'], version
+
+async def _watch_changes(pool: ConnectionPool):
+    """Подхватывает изменения, сделанные другими процессами.
+
+    PRAGMA data_version на отдельном соединении меняется после любого
+    чужого коммита; только тогда читаем хвост change_log.
+    """
+    db = await pool.connect()
+    try:
+        async with db.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log') as cursor:
+            last_seq = (await cursor.fetchone())[0]
+        data_version = None
+        while True:
+            await asyncio.sleep(DB_CHANGE_WATCH_MS / 1000)
+            try:
+                last_seq, data_version = await _poll_changes(pool, db, last_seq, data_version)
+            except Exception:
+                logger.warning("Change log poll failed", exc_info=True)
+    finally:
+        await db.close()
+
+@metrics.timed(metrics.DB_LATENCY, "load_sessions")
+async def _load_sessions():
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT username, token_generation FROM users WHERE token_generation > 0'
+        ) as cursor:
+            generations = {row[0]: row[1] for row in await cursor.fetchall()}
+        async with db.execute('SELECT jti, expires_at FROM revoked_tokens') as cursor:
+            revoked = {row[0]: row[1] for row in await cursor.fetchall()}
+    sessions.load(generations, revoked)
 
+@metrics.timed(metrics.DB_LATENCY, "create_user")
 async def create_user(telegram_id: int, username: str, password_hash: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    pool = await get_pool()
+    async with pool.writer() as db:
         await db.execute(
             'INSERT INTO users (telegram_id, username, password_hash) VALUES (?, ?, ?)',
             (telegram_id, username, password_hash)
         )
-        await db.commit()
+    invalidate_user(username)
 
+@metrics.timed(metrics.DB_LATENCY, "get_user_by_username")
 async def get_user_by_username(username: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    return await _fetch_user(username)
+
+async def _fetch_user(username: str):
+    # Без таймера: его зовут и другие замеряемые функции
+    user = _users.get(username)
+    if user is not MISSING:
+        return user
+    
+    generation = _cache_generation
+    pool = await get_pool()
+    async with pool.reader() as db:
         async with db.execute(
             'SELECT * FROM users WHERE username = ?', (username,)
         ) as cursor:
-            return await cursor.fetchone()
+            user = await cursor.fetchone()
+    _cache_user(user, generation)
+    return user
 
+@metrics.timed(metrics.DB_LATENCY, "get_user_by_telegram_id")
 async def get_user_by_telegram_id(telegram_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    username = _usernames_by_telegram_id.get(telegram_id)
+    if username is not MISSING:
+        user = _users.get(username)
+        if user is not MISSING:
+            return user
+    
+    generation = _cache_generation
+    pool = await get_pool()
+    async with pool.reader() as db:
         async with db.execute(
             'SELECT * FROM users WHERE telegram_id = ?', (telegram_id,)
         ) as cursor:
-            return await cursor.fetchone()
+            user = await cursor.fetchone()
+    _cache_user(user, generation)
+    return user
 
+@metrics.timed(metrics.DB_LATENCY, "update_hwid")
 async def update_hwid(username: str, hwid: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    pool = await get_pool()
+    async with pool.writer() as db:
         await db.execute(
             'UPDATE users SET hwid = ? WHERE username = ?',
             (hwid, username)
         )
-        await db.commit()
+    invalidate_user(username)
 
-async def reset_hwid(username: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+@metrics.timed(metrics.DB_LATENCY, "update_password_hash")
+async def update_password_hash(username: str, password_hash: str):
+    pool = await get_pool()
+    async with pool.writer() as db:
         await db.execute(
-            'UPDATE users SET hwid = NULL WHERE username = ?',
-            (username,)
+            'UPDATE users SET password_hash = ? WHERE username = ?',
+            (password_hash, username)
         )
-        await db.commit()
+    invalidate_user(username)
 
+@metrics.timed(metrics.DB_LATENCY, "reset_hwid")
+async def reset_hwid(username: str):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        async with db.execute(
+            'UPDATE users SET hwid = NULL, token_generation = token_generation + 1 '
+            'WHERE username = ? RETURNING token_generation',
+            (username,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    invalidate_user(username)
+    if row:
+        sessions.set_generation(username, row[0])
+
+@metrics.timed(metrics.DB_LATENCY, "set_subscription")
 async def set_subscription(username: str, end_date: datetime):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            'UPDATE users SET subscription_end = ? WHERE username = ?',
-            (end_date.isoformat(), username)
-        )
-        await db.commit()
+    expires = int(end_date.timestamp())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        # Токены выдаются не дольше срока подписки, поэтому отзываем их
+        # только если подписку укоротили
+        async with db.execute(
+            'UPDATE users SET subscription_end = ?, subscription_expires = ?, '
+            'token_generation = token_generation + (subscription_expires IS NOT NULL AND ? < subscription_expires) '
+            'WHERE username = ? RETURNING token_generation',
+            (end_date.isoformat(), expires, expires, username)
+        ) as cursor:
+            row = await cursor.fetchone()
+    invalidate_user(username)
+    if row:
+        sessions.set_generation(username, row[0])
+        _notify_subscription(username, expires)
+
+def _has_subscription(user) -> bool:
+    expires = user['subscription_expires']
+    return expires is not None and time.time() < expires
 
+@metrics.timed(metrics.DB_LATENCY, "check_subscription")
 async def check_subscription(username: str) -> bool:
-    user = await get_user_by_username(username)
-    if not user or not user['subscription_end']:
-        return False
-    end_date = datetime.fromisoformat(user['subscription_end'])
-    return datetime.now() < end_date
+    user = await _fetch_user(username)
+    return user is not None and _has_subscription(user)
+
+@metrics.timed(metrics.DB_LATENCY, "authenticate_candidate")
+async def authenticate_candidate(username: str):
+    """Всё, что нужно для логина, за одно обращение (или из кэша)."""
+    user = await _fetch_user(username)
+    if user is None:
+        return None
+    return {
+        'password_hash': user['password_hash'],
+        'hwid': user['hwid'],
+        'is_active': bool(user['is_active']),
+        'has_subscription': _has_subscription(user),
+        'subscription_end': user['subscription_end'],
+        'subscription_expires': user['subscription_expires'],
+        'token_generation': user['token_generation'],
+    }
+
+@metrics.timed(metrics.DB_LATENCY, "count_active_subscriptions")
+async def count_active_subscriptions(expiring_within: int = None) -> int:
+    """Активные подписки; с expiring_within - только истекающие в ближайшие N секунд."""
+    now = int(time.time())
+    upper = now + expiring_within if expiring_within is not None else 2 ** 62
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT COUNT(*) FROM users WHERE subscription_expires > ? AND subscription_expires <= ?',
+            (now, upper)
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+# Фильтры админского списка пользователей; :now подставляется при запросе
+USER_LIST_FILTERS = {
+    'all': '1',
+    'active': 'subscription_expires > :now',
+    'expired': '(subscription_expires IS NULL OR subscription_expires <= :now)',
+    'banned': 'is_active = 0',
+    'hwid': 'hwid IS NOT NULL',
+}
+
+@metrics.timed(metrics.DB_LATENCY, "list_users_page")
+async def list_users_page(filter_name: str = 'all', after_id: int = None, before_id: int = None, limit: int = 20):
+    """Страница пользователей по убыванию id (keyset-пагинация).
+
+    after_id - следующая страница (id меньше курсора), before_id - предыдущая.
+    Возвращает (rows, has_newer, has_older); в rows есть has_subscription.
+    """
+    params = {'now': int(time.time()), 'limit': limit + 1}
+    where = [USER_LIST_FILTERS[filter_name]]
+    order = 'DESC'
+    if before_id is not None:
+        where.append('id > :cursor')
+        params['cursor'] = before_id
+        order = 'ASC'
+    elif after_id is not None:
+        where.append('id < :cursor')
+        params['cursor'] = after_id
+    
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT id, username, hwid, is_active, subscription_end, '
+            'COALESCE(subscription_expires > :now, 0) AS has_subscription '
+            f'FROM users WHERE {" AND ".join(where)} ORDER BY id {order} LIMIT :limit',
+            params
+        ) as cursor:
+            rows = await cursor.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, after_id is not None, has_more
+
+@metrics.timed(metrics.DB_LATENCY, "get_user_by_id")
+async def get_user_by_id(user_id: int):
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute('SELECT * FROM users WHERE id = ?', (user_id,)) as cursor:
+            return await cursor.fetchone()
+
+USER_SEARCH_COLUMNS = (
+    'SELECT id, username, telegram_id, hwid, is_active, subscription_end, '
+    'COALESCE(subscription_expires > :now, 0) AS has_subscription FROM users '
+)
+
+@metrics.timed(metrics.DB_LATENCY, "search_users")
+async def search_users(query: str, limit: int = 10, fuzzy: bool = False):
+    """Поиск пользователей для админки, каждый шаг - по индексу.
+
+    По порядку: точные совпадения логина, telegram_id или HWID, логины с
+    префиксом query, логины, содержащие query (триграммы users_fts, нужно
+    минимум 3 символа). Следующий шаг выполняется, только если не набрано limit.
+    fuzzy - если ничего не нашлось, укорачивать префикс (опечатка в логине).
+    """
+    query = query.strip()
+    if not query:
+        return []
+    params = {'q': query, 'now': int(time.time()), 'limit': limit}
+    exact = ['username = :q', 'hwid = :q']
+    if query.lstrip('-').isdigit():
+        exact.append('telegram_id = :telegram_id')
+        params['telegram_id'] = int(query)
+    steps = [
+        f'WHERE {" OR ".join(exact)}',
+        # Префикс - диапазон по уникальному индексу username; U+10FFFF больше любого символа
+        'WHERE username >= :q AND username < :upper ORDER BY username',
+    ]
+    params['upper'] = query + '\U0010ffff'
+    if len(query) >= 3:
+        # Запрос - одна фраза, кавычки внутри экранируются удвоением
+        params['match'] = '"' + query.replace('"', '""') + '"'
+        steps.append('WHERE id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH :match LIMIT :scan) ORDER BY username')
+    # С запасом на строки, уже найденные предыдущими шагами
+    params['scan'] = 2 * limit
+    
+    rows, found = [], set()
+    pool = await get_pool()
+    async with pool.reader() as db:
+        for where in steps:
+            async with db.execute(USER_SEARCH_COLUMNS + where + ' LIMIT :scan', params) as cursor:
+                for row in await cursor.fetchall():
+                    if row['id'] not in found:
+                        found.add(row['id'])
+                        rows.append(row)
+            # Подстрочный поиск по частым триграммам дороже всего - только если не хватило
+            if len(rows) >= limit:
+                break
+        # Нечёткий поиск по триграммам (OR) на частых триграммах читает
+        # чуть ли не весь индекс, а префикс - короткий диапазон
+        prefix = query[:-1]
+        while fuzzy and not rows and len(prefix) >= 3:
+            async with db.execute(USER_SEARCH_COLUMNS + steps[1] + ' LIMIT :limit', {
+                **params, 'q': prefix, 'upper': prefix + '\U0010ffff'
+            }) as cursor:
+                rows = await cursor.fetchall()
+            prefix = prefix[:-1]
+    return rows[:limit]
+
+USER_EXPORT_COLUMNS = (
+    'SELECT id, username, telegram_id, hwid, is_active, created_at, subscription_end, subscription_expires, '
+    'COALESCE(subscription_expires > :now, 0) AS has_subscription, updated_at FROM users '
+)
+
+@metrics.timed_batches(metrics.DB_LATENCY, "iter_users_export")
+async def iter_users_export(since_id: int = None, since_updated: int = None, with_audit: bool = False,
+                            batch_size: int = 1000):
+    """Пользователи для выгрузки пачками по batch_size (списки dict).
 
+    Keyset-пагинация: каждая пачка - отдельный запрос по индексу, читатель
+    пула не держится, пока медленный клиент забирает предыдущую. since_id -
+    только пользователи с id больше (новые), since_updated - изменённые в
+    эту секунду unix-времени или позже, по порядку updated_at. with_audit
+    добавляет счётчики входов из login_audit.
+
+    updated_at хранится с точностью до секунды, поэтому граница включается:
+    при следующей выгрузке с since_updated = последний updated_at ничего не
+    теряется, но строки этой секунды придут повторно. Строка, изменённая во
+    время выгрузки, тоже может прийти дважды - получатель дедуплицирует по id.
+    """
+    params = {'now': int(time.time()), 'limit': batch_size}
+    if since_updated is not None:
+        where, order = '(updated_at, id) > (:updated_at, :id)', 'updated_at, id'
+        params.update(updated_at=since_updated, id=0)
+    else:
+        where, order = 'id > :id', 'id'
+        params['id'] = since_id or 0
+    
+    pool = await get_pool()
+    while True:
+        async with pool.reader() as db:
+            async with db.execute(USER_EXPORT_COLUMNS + f'WHERE {where} ORDER BY {order} LIMIT :limit', params) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+            if rows and with_audit:
+                await _add_login_stats(db, rows)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        params['id'] = rows[-1]['id']
+        params['updated_at'] = rows[-1]['updated_at']
+
+async def _add_login_stats(db, rows):
+    usernames = [row['username'] for row in rows]
+    async with db.execute(
+        'SELECT username, SUM(result = \'ok\') AS logins, SUM(result != \'ok\') AS failed_logins, '
+        'MAX(CASE WHEN result = \'ok\' THEN created_at END) AS last_login_at '
+        f'FROM login_audit WHERE username IN ({", ".join("?" * len(usernames))}) GROUP BY username',
+        usernames
+    ) as cursor:
+        stats = {row['username']: row for row in await cursor.fetchall()}
+    for row in rows:
+        found = stats.get(row['username'])
+        row['logins'] = found['logins'] if found else 0
+        row['failed_logins'] = found['failed_logins'] if found else 0
+        row['last_login_at'] = found['last_login_at'] if found else None
+
+@metrics.timed(metrics.DB_LATENCY, "get_all_users")
 async def get_all_users():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    pool = await get_pool()
+    async with pool.reader() as db:
         async with db.execute('SELECT * FROM users ORDER BY id DESC') as cursor:
             return await cursor.fetchall()
 
+@metrics.timed(metrics.DB_LATENCY, "ban_user")
 async def ban_user(username: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            'UPDATE users SET is_active = 0 WHERE username = ?',
+    pool = await get_pool()
+    async with pool.writer() as db:
+        async with db.execute(
+            'UPDATE users SET is_active = 0, token_generation = token_generation + 1 '
+            'WHERE username = ? RETURNING token_generation',
             (username,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    invalidate_user(username)
+    if row:
+        sessions.set_generation(username, row[0])
+
+@metrics.timed(metrics.DB_LATENCY, "create_refresh_token")
+async def create_refresh_token(token_hash: str, username: str, hwid: str, family: str, generation: int, expires_at: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute(
+            'INSERT INTO refresh_tokens (token_hash, username, hwid, family, generation, expires_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (token_hash, username, hwid, family, generation, expires_at)
+        )
+
+@metrics.timed(metrics.DB_LATENCY, "consume_refresh_token")
+async def consume_refresh_token(token_hash: str):
+    """Помечает refresh-токен использованным и возвращает его запись.
+
+    Повторное предъявление уже обменянного токена означает утечку:
+    удаляем всё семейство токенов и возвращаем None. Обменянный токен
+    нужен только для этой проверки и хранится REFRESH_REUSE_WINDOW_HOURS.
+    """
+    now = int(time.time())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        async with db.execute(
+            'UPDATE refresh_tokens SET used = 1, expires_at = MIN(expires_at, ?) '
+            'WHERE token_hash = ? AND used = 0 AND expires_at > ? '
+            'RETURNING username, hwid, family, generation, expires_at',
+            (now + REFRESH_REUSE_WINDOW_HOURS * 3600, token_hash, now)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            await db.execute(
+                'DELETE FROM refresh_tokens WHERE family IN '
+                '(SELECT family FROM refresh_tokens WHERE token_hash = ? AND used = 1)',
+                (token_hash,)
+            )
+        return row
+
+@metrics.timed(metrics.DB_LATENCY, "prune_expired_tokens")
+async def prune_expired_tokens():
+    """Удаляет истёкшие записи отозванных и refresh-токенов."""
+    now = int(time.time())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute('DELETE FROM revoked_tokens WHERE expires_at < ?', (now,))
+        await db.execute('DELETE FROM refresh_tokens WHERE expires_at < ?', (now,))
+
+@metrics.timed(metrics.DB_LATENCY, "insert_login_events")
+async def insert_login_events(events):
+    """events: (created_at, username, hwid, ip, result, latency_ms)"""
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.executemany(
+            'INSERT INTO login_audit (created_at, username, hwid, ip, result, latency_ms) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            events
+        )
+
+@metrics.timed(metrics.DB_LATENCY, "prune_login_events")
+async def prune_login_events(before: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute('DELETE FROM login_audit WHERE created_at < ?', (before,))
+
+@metrics.timed(metrics.DB_LATENCY, "get_login_failures")
+async def get_login_failures(since: int, limit: int = 20):
+    """Неудачные входы по пользователям с момента since (диапазон по частичному индексу)."""
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            "SELECT username, COUNT(*) AS failures, "
+            "SUM(result = 'hwid_mismatch') AS hwid_mismatches, "
+            "COUNT(DISTINCT hwid) AS hwids, COUNT(DISTINCT ip) AS ips, MAX(created_at) AS last_at "
+            # Без подсказки планировщик выбирает полный проход по индексу username ради GROUP BY
+            "FROM login_audit INDEXED BY idx_login_audit_failures WHERE result != 'ok' AND created_at >= ? "
+            "GROUP BY username ORDER BY failures DESC LIMIT ?",
+            (since, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@metrics.timed(metrics.DB_LATENCY, "revoke_token")
+async def revoke_token(jti: str, expires_at: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute(
+            'INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)',
+            (jti, expires_at)
         )
-        await db.commit()
+    sessions.revoke(jti, expires_at)
+
+@metrics.timed(metrics.DB_LATENCY, "count_broadcast_recipients")
+async def count_broadcast_recipients(audience: str) -> int:
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            f'SELECT COUNT(*) FROM users WHERE telegram_id IS NOT NULL AND {USER_LIST_FILTERS[audience]}',
+            {'now': int(time.time())}
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+@metrics.timed(metrics.DB_LATENCY, "create_broadcast")
+async def create_broadcast(text: str, audience: str, admin_chat_id: int, progress_message_id: int):
+    """Создаёт рассылку и ставит в очередь всех получателей одним INSERT ... SELECT.
+
+    audience - ключ USER_LIST_FILTERS. Возвращает запись рассылки.
+    """
+    now = int(time.time())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        async with db.execute(
+            'INSERT INTO broadcasts (text, audience, admin_chat_id, progress_message_id, created_at) '
+            'VALUES (?, ?, ?, ?, ?) RETURNING id',
+            (text, audience, admin_chat_id, progress_message_id, now)
+        ) as cursor:
+            broadcast_id = (await cursor.fetchone())[0]
+        await db.execute(
+            'INSERT INTO broadcast_queue (broadcast_id, chat_id, next_attempt_at) '
+            f'SELECT :id, telegram_id, :now FROM users WHERE telegram_id IS NOT NULL AND {USER_LIST_FILTERS[audience]}',
+            {'id': broadcast_id, 'now': now}
+        )
+        async with db.execute(
+            'UPDATE broadcasts SET total = (SELECT COUNT(*) FROM broadcast_queue WHERE broadcast_id = :id), '
+            "status = CASE WHEN EXISTS (SELECT 1 FROM broadcast_queue WHERE broadcast_id = :id) "
+            "THEN 'sending' ELSE 'done' END "
+            'WHERE id = :id RETURNING *',
+            {'id': broadcast_id}
+        ) as cursor:
+            return await cursor.fetchone()
+
+@metrics.timed(metrics.DB_LATENCY, "get_due_broadcast_messages")
+async def get_due_broadcast_messages(limit: int):
+    """Сообщения, которым пора уйти: (broadcast_id, chat_id, attempts, text)."""
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT q.broadcast_id, q.chat_id, q.attempts, b.text FROM broadcast_queue q '
+            'JOIN broadcasts b ON b.id = q.broadcast_id '
+            'WHERE q.next_attempt_at <= ? ORDER BY q.next_attempt_at LIMIT ?',
+            (int(time.time()), limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@metrics.timed(metrics.DB_LATENCY, "next_broadcast_attempt")
+async def next_broadcast_attempt():
+    """Время ближайшей отложенной отправки или None, если очередь пуста."""
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute('SELECT MIN(next_attempt_at) FROM broadcast_queue') as cursor:
+            return (await cursor.fetchone())[0]
+
+@metrics.timed(metrics.DB_LATENCY, "finish_broadcast_batch")
+async def finish_broadcast_batch(sent, failed, retry):
+    """Итог пачки отправок одной транзакцией.
+
+    sent, failed - [(broadcast_id, chat_id)], retry - [(attempts, next_attempt_at, broadcast_id, chat_id)].
+    Возвращает записи затронутых рассылок (завершённые уже со status='done').
+    """
+    counts = {}
+    for index, outcomes in ((0, sent), (1, failed)):
+        for broadcast_id, _ in outcomes:
+            counts.setdefault(broadcast_id, [0, 0])[index] += 1
+    touched = set(counts) | {row[2] for row in retry}
+    if not touched:
+        return []
+    
+    placeholders = ','.join('?' * len(touched))
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.executemany(
+            'DELETE FROM broadcast_queue WHERE broadcast_id = ? AND chat_id = ?', [*sent, *failed]
+        )
+        await db.executemany(
+            'UPDATE broadcast_queue SET attempts = ?, next_attempt_at = ? WHERE broadcast_id = ? AND chat_id = ?',
+            retry
+        )
+        await db.executemany(
+            'UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?',
+            [(ok, errors, broadcast_id) for broadcast_id, (ok, errors) in counts.items()]
+        )
+        await db.execute(
+            f"UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id IN ({placeholders}) "
+            "AND status = 'sending' AND NOT EXISTS (SELECT 1 FROM broadcast_queue WHERE broadcast_id = broadcasts.id)",
+            (int(time.time()), *touched)
+        )
+        async with db.execute(f'SELECT * FROM broadcasts WHERE id IN ({placeholders})', tuple(touched)) as cursor:
+            return await cursor.fetchall()
+
+@metrics.timed(metrics.DB_LATENCY, "cancel_broadcast")
+async def cancel_broadcast(broadcast_id: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute('DELETE FROM broadcast_queue WHERE broadcast_id = ?', (broadcast_id,))
+        async with db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'sending' "
+            'RETURNING *',
+            (int(time.time()), broadcast_id)
+        ) as cursor:
+            return await cursor.fetchone()
+
+@metrics.timed(metrics.DB_LATENCY, "get_subscription_schedule")
+async def get_subscription_schedule(since: int):
+    """(username, subscription_expires) с окончанием после since - диапазон по индексу."""
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT username, subscription_expires FROM users '
+            'WHERE subscription_expires > ? AND is_active = 1 ORDER BY subscription_expires',
+            (since,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@metrics.timed(metrics.DB_LATENCY, "claim_expiry_notices")
+async def claim_expiry_notices(notices):
+    """Отмечает напоминания (username, kind, expires) отправленными.
+
+    Возвращает только те, что ещё не отправлялись, вместе с telegram_id;
+    пропускает пользователей, чей срок с тех пор изменился или кто забанен.
+    """
+    now = int(time.time())
+    claimed = []
+    pool = await get_pool()
+    async with pool.writer() as db:
+        for username, kind, expires in notices:
+            async with db.execute(
+                'INSERT INTO expiry_notices (username, kind, expires, sent_at) '
+                'SELECT username, ?, subscription_expires, ? FROM users '
+                'WHERE username = ? AND subscription_expires = ? AND is_active = 1 AND telegram_id IS NOT NULL '
+                'ON CONFLICT DO NOTHING RETURNING (SELECT telegram_id FROM users WHERE username = ?)',
+                (kind, now, username, expires, username)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                claimed.append((username, kind, expires, row[0]))
+    return claimed
+
+@metrics.timed(metrics.DB_LATENCY, "prune_expiry_notices")
+async def prune_expiry_notices(before: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute('DELETE FROM expiry_notices WHERE sent_at < ?', (before,))
+
+# Массовые операции админки: SET для UPDATE ... FROM bulk_targets t.
+# new_expires считается в SQL от текущего срока (extend) или от now (set)
+BULK_OPERATIONS = {
+    'extend': (
+        'subscription_expires = t.new_expires, '
+        "subscription_end = strftime('%Y-%m-%dT%H:%M:%S', t.new_expires, 'unixepoch', 'localtime')",
+        'MAX(COALESCE(u.subscription_expires, 0), :now) + t.days * 86400',
+    ),
+    'set': (
+        'subscription_expires = t.new_expires, '
+        "subscription_end = strftime('%Y-%m-%dT%H:%M:%S', t.new_expires, 'unixepoch', 'localtime'), "
+        # Как в set_subscription: токены отзываются, только если срок укоротили
+        'token_generation = token_generation + (users.subscription_expires IS NOT NULL AND t.new_expires < users.subscription_expires)',
+        ':now + t.days * 86400',
+    ),
+    'ban': ('is_active = 0, token_generation = token_generation + 1', 'NULL'),
+    'reset_hwid': ('hwid = NULL, token_generation = token_generation + 1', 'NULL'),
+}
+
+@metrics.timed(metrics.DB_LATENCY, "bulk_update_users")
+async def bulk_update_users(operation: str, targets):
+    """Применяет операцию к списку пользователей одной транзакцией.
+
+    targets - [(username, days)], days нужен для extend/set. Пользователи
+    сопоставляются одним JOIN с временной таблицей. Возвращает
+    (updated, missing): записи (username, subscription_expires, token_generation)
+    и ненайденные логины.
+    """
+    assignments, new_expires = BULK_OPERATIONS[operation]
+    now = int(time.time())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        # TEMP-таблица живёт в соединении писателя и видна только ему
+        await db.execute('CREATE TEMP TABLE IF NOT EXISTS bulk_targets (username TEXT PRIMARY KEY, days INTEGER)')
+        await db.execute('DELETE FROM temp.bulk_targets')
+        await db.executemany('INSERT OR REPLACE INTO temp.bulk_targets (username, days) VALUES (?, ?)', targets)
+        async with db.execute(
+            'SELECT t.username FROM temp.bulk_targets t LEFT JOIN users u ON u.username = t.username '
+            'WHERE u.id IS NULL ORDER BY t.username'
+        ) as cursor:
+            missing = [row[0] for row in await cursor.fetchall()]
+        async with db.execute(
+            f'UPDATE users SET {assignments} FROM ('
+            f'    SELECT u.id, t.days, {new_expires} AS new_expires '
+            '    FROM temp.bulk_targets t JOIN users u ON u.username = t.username'
+            ') AS t WHERE users.id = t.id '
+            'RETURNING users.username, users.subscription_expires, users.token_generation',
+            {'now': now}
+        ) as cursor:
+            updated = await cursor.fetchall()
+        await db.execute('DELETE FROM temp.bulk_targets')
+    
+    for row in updated:
+        invalidate_user(row['username'])
+        sessions.set_generation(row['username'], row['token_generation'])
+        if operation in ('extend', 'set'):
+            _notify_subscription(row['username'], row['subscription_expires'])
+    return updated, missing
+
+@metrics.timed(metrics.DB_LATENCY, "get_bot_state")
+async def get_bot_state(kind: str, key: str):
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute('SELECT data FROM bot_state WHERE kind = ? AND key = ?', (kind, key)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+@metrics.timed(metrics.DB_LATENCY, "get_bot_states")
+async def get_bot_states(kind: str, since: int):
+    """(key, data) с изменением после since - диапазон по (kind, updated_at)."""
+    pool = await get_pool()
+    async with pool.reader() as db:
+        async with db.execute(
+            'SELECT key, data FROM bot_state WHERE kind = ? AND updated_at > ?', (kind, since)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@metrics.timed(metrics.DB_LATENCY, "save_bot_state")
+async def save_bot_state(upserts, deletes):
+    """upserts - [(kind, key, data)], deletes - [(kind, key)]; одной транзакцией."""
+    now = int(time.time())
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.executemany(
+            'INSERT INTO bot_state (kind, key, data, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+            [(kind, key, data, now) for kind, key, data in upserts]
+        )
+        await db.executemany('DELETE FROM bot_state WHERE kind = ? AND key = ?', deletes)
+
+@metrics.timed(metrics.DB_LATENCY, "prune_bot_state")
+async def prune_bot_state(kind: str, before: int):
+    pool = await get_pool()
+    async with pool.writer() as db:
+        await db.execute('DELETE FROM bot_state WHERE kind = ? AND updated_at < ?', (kind, before))
@@ -0,0 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+class ConnectionPool:
+    """Долгоживущие соединения к SQLite: N читателей и один писатель.
+
+    Писатель сериализован через asyncio.Lock, читатели выдаются из очереди.
+    PRAGMA выставляются один раз при открытии соединения.
+    """
+
+    def __init__(self, path: str, readers: int = 4, cached_statements: int = 128, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all_readers = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._closed = False
+
+    async def connect(self, isolation_level: str = "") -> aiosqlite.Connection:
+        db = await aiosqlite.connect(
+            self.path, cached_statements=self.cached_statements, isolation_level=isolation_level
+        )
+        db.row_factory = aiosqlite.Row
+        try:
+            await db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+            await db.execute("PRAGMA synchronous = NORMAL")
+        except BaseException:
+            await db.close()
+            raise
+        return db
+
+    async def open(self):
+        # IMMEDIATE: писатель берёт блокировку в начале транзакции, поэтому
+        # несколько процессов на одном файле ждут по busy_timeout, а не ловят
+        # SQLITE_BUSY при повышении блокировки посреди транзакции
+        self._writer = await self.connect(isolation_level="IMMEDIATE")
+        # WAL включается на уровне файла БД, достаточно одного раза через писателя
+        async with self._writer.execute("PRAGMA journal_mode = WAL") as cursor:
+            await cursor.fetchone()
+        for _ in range(self.readers_count):
+            conn = await self.connect()
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Дожидаемся завершения текущей записи
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.close()
+        # Забираем всех читателей, чтобы не закрыть соединение посреди запроса
+        for _ in range(len(self._all_readers)):
+            conn = await self._readers.get()
+            await conn.close()
+        self._all_readers.clear()
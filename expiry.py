@@ -0,0 +1,157 @@
+import heapq
+import logging
+import time
+from datetime import datetime
+
+from telegram.error import TelegramError
+from telegram.ext import Application, ContextTypes
+
+import broadcast
+import database
+import metrics
+from config import EXPIRY_NOTICE_BEFORE, EXPIRY_CATCHUP_SECONDS, EXPIRY_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+SOON, EXPIRED = "soon", "expired"
+JOB_NAME = "subscription_expiry"
+
+class ExpiryScheduler:
+    """Напоминания об окончании подписки.
+
+    Куча (fire_at, username, kind, expires) загружается один раз запросом
+    по индексу subscription_expires и дополняется при set_subscription
+    за O(log n). Устаревшие записи не удаляются из кучи, а пропускаются:
+    актуальный срок каждого пользователя лежит в _expires. Срабатывает
+    одна задача job queue на время вершины кучи.
+    """
+
+    def __init__(self, application: Application):
+        self.application = application
+        self._heap = []
+        self._expires = {}
+        self._job = None
+        self._job_at = None
+        self.sent = 0
+
+    async def start(self):
+        now = int(time.time())
+        await database.prune_expiry_notices(now - EXPIRY_NOTICE_BEFORE - 30 * 86400)
+        # Истёкшие за время простоя тоже получают напоминание (повторы отсекает expiry_notices)
+        rows = await database.get_subscription_schedule(now - EXPIRY_CATCHUP_SECONDS)
+        for row in rows:
+            self._expires[row['username']] = row['subscription_expires']
+            self._heap.extend(self._entries(row['username'], row['subscription_expires'], now))
+        heapq.heapify(self._heap)
+        database.add_subscription_listener(self.on_subscription_changed)
+        self._reschedule()
+        logger.info("Expiry scheduler loaded %d subscriptions", len(rows))
+
+    def stop(self):
+        database.remove_subscription_listener(self.on_subscription_changed)
+        # После остановки JobQueue (post_stop) задач в ней уже нет
+        if self._job is not None and self.application.job_queue.scheduler.running:
+            self._job.schedule_removal()
+        self._job = None
+
+    @staticmethod
+    def _entries(username: str, expires: int, now: int):
+        if expires > now:
+            yield (max(now, expires - EXPIRY_NOTICE_BEFORE), username, SOON, expires)
+        yield (expires, username, EXPIRED, expires)
+
+    def on_subscription_changed(self, username: str, expires):
+        if expires is None:
+            self._expires.pop(username, None)
+            return
+        now = int(time.time())
+        self._expires[username] = expires
+        for entry in self._entries(username, expires, now):
+            heapq.heappush(self._heap, entry)
+        self._compact()
+        self._reschedule()
+
+    def _is_current(self, entry) -> bool:
+        return self._expires.get(entry[1]) == entry[3]
+
+    def _compact(self):
+        # На пользователя приходится не больше двух живых записей
+        if len(self._heap) > 4 * len(self._expires) + 1024:
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+    def _reschedule(self):
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        fire_at = self._heap[0][0] if self._heap else None
+        if fire_at == self._job_at:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._job_at = fire_at
+        if fire_at is not None:
+            self._job = self.application.job_queue.run_once(
+                self._fire, when=datetime.fromtimestamp(max(fire_at, time.time())).astimezone(), name=JOB_NAME
+            )
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        self._job_at = None
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < EXPIRY_BATCH_SIZE:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                due.append((entry[1], entry[2], entry[3]))
+            if entry[2] == EXPIRED and self._is_current(entry):
+                # После последнего напоминания пользователь больше не нужен
+                self._expires.pop(entry[1], None)
+        try:
+            if due:
+                for username, kind, expires, telegram_id in await database.claim_expiry_notices(due):
+                    await self._notify(telegram_id, kind, expires)
+        except Exception:
+            logger.warning("Expiry notifications failed", exc_info=True)
+        finally:
+            self._reschedule()
+
+    async def _notify(self, telegram_id: int, kind: str, expires: int):
+        if kind == SOON:
+            text = (
+                f"⏳ Подписка истекает {datetime.fromtimestamp(expires).strftime('%Y-%m-%d %H:%M')}\n\n"
+                "Для продления обратитесь к администратору."
+            )
+        else:
+            text = "❌ Подписка истекла\n\nДля продления обратитесь к администратору."
+        await broadcast.acquire()
+        try:
+            await self.application.bot.send_message(telegram_id, text)
+            self.sent += 1
+        except TelegramError:
+            logger.debug("Expiry notice to %s failed", telegram_id, exc_info=True)
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._expires), "heap": len(self._heap), "sent": self.sent}
+
+scheduler: ExpiryScheduler = None
+
+async def start(application: Application):
+    global scheduler
+    if application.job_queue is None:
+        logger.warning("JobQueue is unavailable (install python-telegram-bot[job-queue]), expiry notices are off")
+        return
+    scheduler = ExpiryScheduler(application)
+    await scheduler.start()
+
+def stop():
+    global scheduler
+    if scheduler is not None:
+        scheduler.stop()
+        scheduler = None
+
+def stats() -> dict:
+    """Пусто, если планировщик не запущен в этом процессе."""
+    return scheduler.stats() if scheduler is not None else {}
+
+metrics.register_stats("matrix_expiry_scheduler", "Subscription expiry scheduler state", stats)
@@ -0,0 +1,40 @@
+import csv
+import io
+import json
+
+import database
+import metrics
+from config import EXPORT_BATCH_SIZE
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+FIELDS = (
+    "id", "username", "telegram_id", "hwid", "is_active", "created_at",
+    "subscription_end", "subscription_expires", "has_subscription", "updated_at",
+)
+AUDIT_FIELDS = ("logins", "failed_logins", "last_login_at")
+
+async def stream(fmt: str, since_id: int = None, since_updated: int = None, with_audit: bool = False):
+    """Выгрузка пользователей по кускам bytes (по одному на пачку из БД).
+
+    В памяти одновременно только одна пачка, сколько бы ни было пользователей.
+    """
+    fields = FIELDS + AUDIT_FIELDS if with_audit else FIELDS
+    if fmt == "csv":
+        # BOM: Excel иначе открывает UTF-8 как cp1251
+        yield ("\ufeff" + ",".join(fields) + "\r\n").encode()
+
+    async for rows in database.iter_users_export(since_id, since_updated, with_audit, EXPORT_BATCH_SIZE):
+        if fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([row[field] for field in fields] for row in rows)
+            chunk = buffer.getvalue()
+        else:
+            chunk = "".join(
+                json.dumps({field: row[field] for field in fields}, ensure_ascii=False) + "\n" for row in rows
+            )
+        metrics.EXPORT_ROWS.inc(fmt, amount=len(rows))
+        yield chunk.encode()
@@ -1,18 +1,35 @@
-import asyncio
-import threading
+import logging
+import multiprocessing
+import os
+
 import uvicorn
 
-from bot import main as run_bot
-from api import app
-from config import API_HOST, API_PORT
+from config import API_HOST, API_PORT, API_WORKERS
 
-def run_api():
-    uvicorn.run(app, host=API_HOST, port=API_PORT)
+def run_bot():
+    from bot import main as bot_main
+    bot_main()
 
 if __name__ == "__main__":
-    # Запускаем API в отдельном потоке
-    api_thread = threading.Thread(target=run_api, daemon=True)
-    api_thread.start()
-    
-    # Запускаем бота в основном потоке
-    run_bot()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # httpx пишет в INFO каждый запрос к Telegram (long polling)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if API_WORKERS > 1:
+        # N процессов API + отдельный процесс бота на одной SQLite (WAL).
+        # Кэши согласуются через change_log (см. database._watch_changes).
+        bot_process = multiprocessing.Process(target=run_bot, name="bot")
+        bot_process.start()
+        
+        # Настройки наследуются воркерами uvicorn через окружение
+        os.environ["BOT_ENABLED"] = "0"
+        os.environ.setdefault("PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 1) // API_WORKERS)))
+        try:
+            uvicorn.run("api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
+        finally:
+            bot_process.terminate()
+            bot_process.join()
+    else:
+        # API и бот работают в одном процессе на одном event loop:
+        # бот запускается в lifespan FastAPI
+        from api import app
+        uvicorn.run(app, host=API_HOST, port=API_PORT)
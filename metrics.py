@@ -0,0 +1,162 @@
+import functools
+import time
+from bisect import bisect_left
+
+# Метрики в формате Prometheus. Значения обновляются только из потока
+# event loop, поэтому блокировки не нужны; серия - это заранее выделенный
+# список счётчиков, observe() не создаёт объектов.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, max_series: int = 500):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Защита от взрыва числа серий, если метка пришла извне
+        self.max_series = max_series
+        # labels -> [count в каждом бакете..., +Inf, sum]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            if len(self._series) >= self.max_series:
+                labels = ("other",) * len(self.labelnames)
+                series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            cumulative += series[len(self.buckets)]
+            le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_number(series[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+class GaugeFunction:
+    """Значения снимаются в момент выдачи /metrics: fn() -> {labels tuple: value}."""
+
+    def __init__(self, name: str, documentation: str, labelnames, fn):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.fn().items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+
+def register_stats(name: str, documentation: str, fn, label: str = "stat") -> GaugeFunction:
+    """Gauge из функции stats() компонента: {ключ: значение} -> серии с меткой label.
+
+    Пустой словарь (компонент не запущен в этом процессе) даёт пустую метрику.
+    """
+    return GaugeFunction(
+        name, documentation, (label,),
+        lambda: {(key,): value for key, value in fn().items()},
+    )
+
+def timed(histogram: Histogram, *labels):
+    """Декоратор для корутин: длительность вызова в histogram."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+def timed_batches(histogram: Histogram, *labels):
+    """Декоратор для асинхронных генераторов: время получения каждой пачки.
+
+    Пока потребитель обрабатывает пачку, время не идёт.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            batches = fn(*args, **kwargs)
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        batch = await batches.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    histogram.observe(time.perf_counter() - started, *labels)
+                    yield batch
+            finally:
+                await batches.aclose()
+        return wrapper
+    return decorator
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HTTP_REQUESTS = Counter("matrix_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("matrix_http_request_seconds", "HTTP request latency", ("method", "route"))
+DB_LATENCY = Histogram("matrix_db_call_seconds", "database.py call latency (cache hits included)", ("function",))
+PASSWORD_QUEUE = Histogram("matrix_password_queue_seconds", "Time bcrypt jobs wait for a worker thread", ("operation",))
+PASSWORD_WORK = Histogram("matrix_password_work_seconds", "Time spent in bcrypt", ("operation",))
+UPSTREAM_BYTES = Counter("matrix_upstream_bytes_total", "Bytes fetched from CLIENT_JAR_URL", ("mode",))
+UPSTREAM_LATENCY = Histogram("matrix_upstream_fetch_seconds", "Duration of upstream JAR fetches", ("mode", "status"),
+                             buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+BOT_LATENCY = Histogram("matrix_bot_handler_seconds", "Bot handler latency by callback or state", ("handler",))
+BOT_UPDATE_WAIT = Histogram("matrix_bot_update_wait_seconds", "Time a bot update waits for its chat and a free slot")
+EXPORT_ROWS = Counter("matrix_export_rows_total", "Users streamed by /admin/export and /export", ("format",))
+LOGIN_ADMISSION = Counter("matrix_login_admission_total", "Login attempts admitted or shed before bcrypt", ("result",))
+BOT_HANDLER_TIMEOUTS = Counter("matrix_bot_handler_timeouts_total", "Bot handlers cancelled by timeout", ("handler",))
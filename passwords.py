@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+import metrics
+from config import BCRYPT_ROUNDS, PASSWORD_WORKERS, PASSWORD_MAX_QUEUE
+
+# min/max = default: хеши с другой стоимостью помечаются как требующие обновления
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+class PasswordPoolBusy(Exception):
+    pass
+
+class PasswordPool:
+    """Ограниченный пул потоков для bcrypt (bcrypt отпускает GIL).
+
+    Задачи сверх workers + max_queue сразу отклоняются с PasswordPoolBusy,
+    чтобы всплеск логинов не копил бесконечную очередь.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        # API и бот могут жить в разных потоках, поэтому счётчики под threading.Lock
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    @staticmethod
+    def _timed_call(fn, args):
+        started = time.perf_counter()
+        return fn(*args), started, time.perf_counter()
+
+    async def run(self, operation: str, fn, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordPoolBusy()
+            self._pending += 1
+            self.peak_pending = max(self.peak_pending, self._pending)
+        submitted = time.perf_counter()
+        try:
+            future = self._executor.submit(self._timed_call, fn, args)
+        except BaseException:
+            self._release(None)
+            raise
+        # Счётчик уменьшается, когда поток действительно закончил работу,
+        # даже если ожидающая корутина была отменена
+        future.add_done_callback(self._release)
+        result, started, finished = await asyncio.wrap_future(future)
+        # Метрики пишем уже в потоке event loop
+        metrics.PASSWORD_QUEUE.observe(started - submitted, operation)
+        metrics.PASSWORD_WORK.observe(finished - started, operation)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._pending
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": min(pending, self.workers),
+                "queued": max(0, pending - self.workers),
+                "peak_pending": self.peak_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_MAX_QUEUE)
+
+async def hash_password(password: str) -> str:
+    return await pool.run("hash", pwd_context.hash, password)
+
+async def verify_password(password: str, password_hash: str):
+    """Возвращает (ok, new_hash); new_hash не None, если хеш нужно пересчитать."""
+    return await pool.run("verify", pwd_context.verify_and_update, password, password_hash)
+
+def stats() -> dict:
+    return pool.stats()
+
+metrics.register_stats("matrix_password_pool", "bcrypt pool saturation", pool.stats, label="state")
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import time
+
+from telegram.ext import Application, BasePersistence, PersistenceInput
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+USER_KIND = "user"
+
+class SQLitePersistence(BasePersistence):
+    """user_data и состояния ConversationHandler в таблице bot_state общей БД.
+
+    Запись отложенная: Application раз в update_interval передаёт
+    изменившиеся данные, они копятся в _staged и пишутся одной
+    транзакцией. user_data читается лениво при первом обновлении
+    пользователя (refresh_user_data), простаивающие пользователи
+    выгружаются из памяти (evict_idle), но остаются в БД.
+    """
+
+    def __init__(self, update_interval: float, idle_seconds: float, retention_seconds: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.idle_seconds = idle_seconds
+        self.retention_seconds = retention_seconds
+        # (kind, key) -> JSON или None (удалить)
+        self._staged = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        # user_id -> время последнего обновления; есть в словаре - данные в памяти
+        self._loaded = {}
+        self._evicted = set()
+        self.loads = 0
+        self.writes = 0
+        self.evictions = 0
+
+    # --- загрузка ---
+
+    async def get_user_data(self):
+        # Ничего не грузим заранее: см. refresh_user_data
+        await database.init_db()
+        await database.prune_bot_state(USER_KIND, int(time.time() - self.retention_seconds))
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        # Диалоги, простаивающие дольше conversation_timeout, всё равно
+        # были бы завершены - их не загружаем и удаляем
+        await database.init_db()
+        kind = f"conv:{name}"
+        since = int(time.time() - self.idle_seconds)
+        await database.prune_bot_state(kind, since)
+        return {
+            tuple(json.loads(row['key'])): json.loads(row['data'])
+            for row in await database.get_bot_states(kind, since)
+        }
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        if user_id in self._loaded:
+            self._loaded[user_id] = time.monotonic()
+            return
+        self._loaded[user_id] = time.monotonic()
+        key = (USER_KIND, str(user_id))
+        # Ещё не записанная версия новее той, что в БД
+        data = self._staged[key] if key in self._staged else await database.get_bot_state(*key)
+        self.loads += 1
+        if data:
+            # Всё, что успел записать текущий обработчик, важнее сохранённого
+            for name, value in json.loads(data).items():
+                user_data.setdefault(name, value)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- запись ---
+
+    def _stage(self, key, data):
+        self._staged[key] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Application вызывает update_* пачкой (asyncio.gather); даём им
+        # всем попасть в _staged и пишем одной транзакцией
+        await asyncio.sleep(0.05)
+        await self.flush()
+
+    async def update_user_data(self, user_id: int, data):
+        self._stage((USER_KIND, str(user_id)), json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._stage((f"conv:{name}", json.dumps(list(key))), None if new_state is None else json.dumps(new_state))
+
+    async def drop_user_data(self, user_id: int):
+        if user_id in self._evicted:
+            # Выгружен из памяти по простою - в БД данные остаются
+            self._evicted.discard(user_id)
+            return
+        self._loaded.pop(user_id, None)
+        self._stage((USER_KIND, str(user_id)), None)
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._staged:
+                return
+            staged, self._staged = self._staged, {}
+            upserts = [(kind, key, data) for (kind, key), data in staged.items() if data is not None]
+            deletes = [(kind, key) for (kind, key), data in staged.items() if data is None]
+            try:
+                await database.save_bot_state(upserts, deletes)
+                self.writes += len(staged)
+            except Exception:
+                # Вернём в очередь, если не перезаписано более новой версией
+                for key, data in staged.items():
+                    self._staged.setdefault(key, data)
+                logger.warning("Failed to save %d bot state entries", len(staged), exc_info=True)
+
+    # --- вытеснение ---
+
+    def evict_idle(self, application: Application):
+        """Выгружает из памяти user_data пользователей без обновлений дольше idle_seconds."""
+        deadline = time.monotonic() - self.idle_seconds
+        for user_id, seen in list(self._loaded.items()):
+            if seen < deadline:
+                del self._loaded[user_id]
+                self._evicted.add(user_id)
+                application.drop_user_data(user_id)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "loaded": len(self._loaded),
+            "staged": len(self._staged),
+            "loads": self.loads,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+persistence: SQLitePersistence = None
+
+def create(update_interval: float, idle_seconds: float, retention_seconds: float) -> SQLitePersistence:
+    global persistence
+    persistence = SQLitePersistence(update_interval, idle_seconds, retention_seconds)
+    return persistence
+
+def stats() -> dict:
+    """Пусто, если бот не запущен в этом процессе."""
+    return persistence.stats() if persistence is not None else {}
+
+metrics.register_stats("matrix_bot_state", "Bot persistence: loaded users and write-behind counters", stats)
@@ -0,0 +1,168 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from config import (
+    LOADER_VERSION, LOADER_DOWNLOAD_URL, LOADER_CHANGELOG,
+    RELEASE_MANIFEST_PATH, RELEASE_MANIFEST_CHECK_SECONDS, UPDATE_CHECK_MAX_AGE,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = "stable"
+
+_VERSION_RE = re.compile(
+    r"^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?"
+    r"(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?"
+    r"(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?$"
+)
+
+@functools.lru_cache(maxsize=1024)
+def parse_version(version: str):
+    """Ключ сравнения по semver: 1.0.0-beta < 1.0.0-beta.2 < 1.0.0 < 1.0.1.
+
+    Недостающие части считаются нулями (1.2 == 1.2.0), метаданные сборки
+    (+...) игнорируются. Для некорректной строки возвращает None.
+    Лоадеры шлют небольшой набор версий, поэтому разбор кэшируется.
+    """
+    match = _VERSION_RE.match(version.strip())
+    if match is None:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    core = (int(major), int(minor or 0), int(patch or 0))
+    if prerelease is None:
+        # Релиз старше любой своей пре-версии
+        return core + ((1,),)
+    identifiers = tuple(
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in prerelease.split(".")
+    )
+    return core + ((0,) + identifiers,)
+
+class Release:
+    __slots__ = ("version", "key", "download_url", "changelog")
+
+    def __init__(self, version: str, download_url: str, changelog: str):
+        key = parse_version(version)
+        if key is None:
+            raise ValueError(f"Invalid version: {version!r}")
+        self.version = version
+        self.key = key
+        self.download_url = download_url
+        self.changelog = changelog
+
+class PreparedResponse:
+    """Готовое тело ответа /update/check и его ETag."""
+
+    __slots__ = ("body", "etag")
+
+    def __init__(self, payload: dict):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+
+class Manifest:
+    """Каналы релизов лоадера и заранее сериализованные ответы.
+
+    На канал приходится ровно два варианта ответа: обновление есть
+    (клиент старше релиза канала или прислал некорректную версию) и
+    обновления нет, поэтому запрос сводится к одному сравнению ключей.
+    """
+
+    def __init__(self, channels: dict):
+        self.channels = channels
+        self.responses = {}
+        for name, release in channels.items():
+            self.responses[(name, True)] = PreparedResponse({
+                "update_available": True,
+                "latest_version": release.version,
+                "download_url": release.download_url,
+                "changelog": release.changelog,
+            })
+            self.responses[(name, False)] = PreparedResponse({
+                "update_available": False,
+                "latest_version": release.version,
+                "download_url": "",
+                "changelog": "",
+            })
+
+    def check(self, channel: str, version: str) -> PreparedResponse:
+        if channel not in self.channels:
+            channel = DEFAULT_CHANNEL
+        key = parse_version(version)
+        update_available = key is None or key < self.channels[channel].key
+        return self.responses[(channel, update_available)]
+
+def _fallback_release() -> Release:
+    return Release(LOADER_VERSION, LOADER_DOWNLOAD_URL, LOADER_CHANGELOG)
+
+def build_manifest(data: dict) -> Manifest:
+    """Манифест из JSON вида {"channels": {"stable": {"version": ..., "download_url": ..., "changelog": ...}}}.
+
+    Без stable в файле используется релиз из config.py. Канал не может
+    отставать от stable: бета-тестеры получают стабильный релиз, если он новее.
+    """
+    raw_channels = data.get("channels")
+    if not isinstance(raw_channels, dict):
+        raise ValueError("Manifest must contain a 'channels' object")
+    channels = {}
+    for name, entry in raw_channels.items():
+        channels[name] = Release(
+            str(entry["version"]),
+            entry.get("download_url", LOADER_DOWNLOAD_URL),
+            entry.get("changelog", ""),
+        )
+    stable = channels.setdefault(DEFAULT_CHANNEL, _fallback_release())
+    for name, release in channels.items():
+        if release.key < stable.key:
+            channels[name] = stable
+    return Manifest(channels)
+
+# Текущий манифест процесса; файл перечитывается при смене mtime,
+# stat() делается не чаще раза в RELEASE_MANIFEST_CHECK_SECONDS
+_manifest = Manifest({DEFAULT_CHANNEL: _fallback_release()})
+_manifest_mtime = None
+_next_check = 0.0
+
+def _reload():
+    global _manifest, _manifest_mtime
+    try:
+        mtime = os.stat(RELEASE_MANIFEST_PATH).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime == _manifest_mtime:
+        return
+    if mtime is None:
+        _manifest = Manifest({DEFAULT_CHANNEL: _fallback_release()})
+        _manifest_mtime = None
+        return
+    try:
+        with open(RELEASE_MANIFEST_PATH, encoding="utf-8") as f:
+            manifest = build_manifest(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # Оставляем предыдущий манифест, пока файл не исправят
+        logger.warning("Invalid release manifest %s", RELEASE_MANIFEST_PATH, exc_info=True)
+        _manifest_mtime = mtime
+        return
+    _manifest = manifest
+    _manifest_mtime = mtime
+    logger.info(
+        "Release manifest loaded: %s",
+        ", ".join(f"{name}={release.version}" for name, release in manifest.channels.items()),
+    )
+
+def current() -> Manifest:
+    global _next_check
+    now = time.monotonic()
+    if now >= _next_check:
+        _next_check = now + RELEASE_MANIFEST_CHECK_SECONDS
+        _reload()
+    return _manifest
+
+def check(channel: str, version: str) -> PreparedResponse:
+    return current().check(channel, version)
+
+CACHE_CONTROL = f"public, max-age={UPDATE_CHECK_MAX_AGE}"
@@ -0,0 +1,40 @@
+import time
+
+# Реестр сессий в памяти: проверка токена без обращения к БД.
+# Храним только отличия от значений по умолчанию: поколение токенов
+# пользователя (0, пока его не банили/не сбрасывали HWID) и отозванные jti.
+_generations = {}
+_revoked = {}
+
+PRUNE_EVERY = 1000
+
+def load(generations, revoked):
+    _generations.clear()
+    _generations.update(generations)
+    _revoked.clear()
+    _revoked.update(revoked)
+
+def generation(username: str) -> int:
+    return _generations.get(username, 0)
+
+def set_generation(username: str, value: int):
+    if value:
+        _generations[username] = value
+    else:
+        _generations.pop(username, None)
+
+def revoke(jti: str, expires_at: int):
+    _revoked[jti] = expires_at
+    if len(_revoked) % PRUNE_EVERY == 0:
+        prune()
+
+def prune():
+    now = time.time()
+    for jti, expires_at in list(_revoked.items()):
+        if expires_at < now:
+            _revoked.pop(jti, None)
+
+def is_valid(username: str, token_generation: int, jti: str) -> bool:
+    if jti in _revoked:
+        return False
+    return token_generation == _generations.get(username, 0)
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# БД и кэш артефактов лежат по относительным путям из config:
+# тесты работают во временном каталоге
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="matrix-tests-"))
+# Модули читают config при импорте: окружение задаётся до них
+os.environ["ARTIFACT_CACHE_DIR"] = ""
+os.environ["BOT_ENABLED"] = "0"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["DB_CHANGE_WATCH_MS"] = "0"
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import api
+    with TestClient(api.app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def fresh_db(monkeypatch, tmp_path):
+    """Пустая БД только для этого теста."""
+    import database
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "test.db"))
+
+@pytest.fixture
+def run():
+    """Выполняет корутину на отдельном event loop с инициализированной БД."""
+    import database
+
+    def runner(scenario):
+        async def wrapper():
+            await database.init_db()
+            try:
+                return await scenario()
+            finally:
+                await database.close_db()
+        return asyncio.run(wrapper())
+    return runner
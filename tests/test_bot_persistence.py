@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+from telegram import Update, User
+from telegram.ext import Application, ConversationHandler, ExtBot, MessageHandler, filters
+
+import database
+import persistence
+
+ASK_NAME, ASK_AGE = range(2)
+USER_ID = 4242
+
+@pytest.fixture
+def offline_bot(monkeypatch):
+    """Application.initialize без запроса getMe к Telegram."""
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(1, "Matrix test bot", is_bot=True, username="matrix_test_bot")
+        return self._bot_user
+    monkeypatch.setattr(ExtBot, "get_me", get_me)
+
+def build_application(answers: list) -> Application:
+    """Отдельный экземпляр бота со своей persistence, как после перезапуска процесса."""
+    store = persistence.SQLitePersistence(update_interval=60, idle_seconds=3600, retention_seconds=86400)
+    app = Application.builder().token("1:test").persistence(store).updater(None).build()
+
+    async def begin(update, context):
+        context.user_data["started_at"] = update.message.date.isoformat()
+        return ASK_NAME
+
+    async def ask_name(update, context):
+        context.user_data["name"] = update.message.text
+        return ASK_AGE
+
+    async def ask_age(update, context):
+        answers.append((context.user_data.get("name"), update.message.text))
+        return ConversationHandler.END
+
+    app.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^go$"), begin)],
+        states={
+            ASK_NAME: [MessageHandler(filters.TEXT, ask_name)],
+            ASK_AGE: [MessageHandler(filters.TEXT, ask_age)],
+        },
+        fallbacks=[],
+        name="signup",
+        persistent=True,
+    ))
+    return app
+
+def message(app: Application, update_id: int, text: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": USER_ID, "type": "private"},
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "Alice"},
+            "text": text,
+        },
+    }, app.bot)
+
+@pytest.mark.usefixtures("fresh_db", "offline_bot")
+def test_conversation_and_user_data_survive_rebuild(run):
+    async def scenario():
+        answers = []
+        first = build_application(answers)
+        await first.initialize()
+        await first.process_update(message(first, 1, "go"))
+        await first.process_update(message(first, 2, "Alice"))
+        # shutdown сбрасывает отложенную запись в БД
+        await first.shutdown()
+        assert [row["key"] for row in await database.get_bot_states("conv:signup", 0)] == [f"[{USER_ID}, {USER_ID}]"]
+
+        second = build_application(answers)
+        await second.initialize()
+        await second.process_update(message(second, 3, "30"))
+        assert answers == [("Alice", "30")]
+        assert second.user_data[USER_ID]["name"] == "Alice"
+        assert "started_at" in second.user_data[USER_ID]
+        await second.shutdown()
+        # Диалог завершён: состояние удалено, user_data осталась
+        assert await database.get_bot_states("conv:signup", 0) == []
+        assert await database.get_bot_state(persistence.USER_KIND, str(USER_ID))
+    run(scenario)
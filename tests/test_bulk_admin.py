@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+import bot
+import database
+import sessions
+
+def test_parse_bulk_targets_with_days():
+    text = 'username,days\nalice,5\n"bob";0\ncarol\ndave, erin\nfrank 12\n'
+    targets, errors = bot.parse_bulk_targets(text, 30)
+    assert targets == [("alice", 5), ("carol", 30), ("dave", 30), ("erin", 30), ("frank", 12)]
+    assert errors == ['"bob";0']
+
+def test_parse_bulk_targets_ignores_days_for_ban_and_reset():
+    targets, errors = bot.parse_bulk_targets("alice,5\nbob,-1\ncarol dave", None)
+    assert targets == [("alice", None), ("bob", None), ("carol", None), ("dave", None)]
+    assert errors == []
+
+@pytest.mark.usefixtures("fresh_db")
+def test_bulk_extend_uses_per_line_days_and_reports_missing(run):
+    async def scenario():
+        await database.create_user(9001, "bulk_a", "hash")
+        await database.create_user(9002, "bulk_b", "hash")
+        before = int(time.time())
+        updated, missing = await database.bulk_update_users(
+            "extend", [("bulk_a", 5), ("ghost", 7), ("bulk_b", 10), ("another_ghost", 1)]
+        )
+        expires = {row["username"]: row["subscription_expires"] for row in updated}
+        assert missing == ["another_ghost", "ghost"]
+        assert set(expires) == {"bulk_a", "bulk_b"}
+        assert before + 5 * 86400 <= expires["bulk_a"] <= int(time.time()) + 5 * 86400
+        assert before + 10 * 86400 <= expires["bulk_b"] <= int(time.time()) + 10 * 86400
+        # Кэш сброшен: чтение видит новый срок
+        assert await database.check_subscription("bulk_a")
+        assert (await database.get_user_by_username("bulk_b"))["subscription_expires"] == expires["bulk_b"]
+
+        # extend продлевает от текущего срока, а не от сегодняшнего дня
+        updated, _ = await database.bulk_update_users("extend", [("bulk_a", 1)])
+        assert updated[0]["subscription_expires"] == expires["bulk_a"] + 86400
+    run(scenario)
+
+@pytest.mark.usefixtures("fresh_db")
+def test_bulk_ban_revokes_tokens(run):
+    async def scenario():
+        await database.create_user(9011, "bulk_ban", "hash")
+        generation = (await database.authenticate_candidate("bulk_ban"))["token_generation"]
+        updated, missing = await database.bulk_update_users("ban", [("bulk_ban", None), ("ghost", None)])
+        assert missing == ["ghost"]
+        assert [row["username"] for row in updated] == ["bulk_ban"]
+        user = await database.get_user_by_username("bulk_ban")
+        assert user["is_active"] == 0
+        assert not sessions.is_valid("bulk_ban", generation, "jti")
+    run(scenario)
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import metrics
+
+async def export_all(**options):
+    rows = []
+    async for batch in database.iter_users_export(**options):
+        rows.extend(batch)
+    return rows
+
+def export_batches_timed() -> int:
+    series = metrics.DB_LATENCY._series.get(("iter_users_export",))
+    return sum(series[:-1]) if series else 0
+
+@pytest.mark.usefixtures("fresh_db")
+def test_since_updated_includes_the_boundary_second(run):
+    async def scenario():
+        for i in range(5):
+            await database.create_user(9100 + i, f"export_{i}", "hash")
+        first = await export_all(since_updated=0, batch_size=2)
+        assert [row['username'] for row in first] == [f"export_{i}" for i in range(5)]
+
+        # Следующая выгрузка начинается с последнего увиденного updated_at.
+        # Изменение в ту же секунду не теряется, уже выгруженные строки
+        # этой секунды приходят повторно
+        last_seen = max(row['updated_at'] for row in first)
+        await database.set_subscription("export_0", datetime.now() + timedelta(days=1))
+        second = await export_all(since_updated=last_seen, batch_size=2)
+        ids = [row['id'] for row in second]
+        assert len(ids) == len(set(ids))
+        changed = next(row for row in second if row['username'] == "export_0")
+        assert changed['has_subscription'] == 1
+    run(scenario)
+
+@pytest.mark.usefixtures("fresh_db")
+def test_since_id_pages_by_id_and_times_each_batch(run):
+    async def scenario():
+        for i in range(5):
+            await database.create_user(9200 + i, f"export_id_{i}", "hash")
+        before = export_batches_timed()
+        rows = await export_all(since_id=2, batch_size=2)
+        assert [row['id'] for row in rows] == [3, 4, 5]
+        assert export_batches_timed() - before == 2
+    run(scenario)
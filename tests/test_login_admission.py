@@ -0,0 +1,63 @@
+import pytest
+from starlette.requests import Request
+
+import admission
+import api
+
+def make_request(peer: str, *forwarded: str) -> Request:
+    headers = [(b"x-forwarded-for", value.encode()) for value in forwarded]
+    return Request({"type": "http", "headers": headers, "client": (peer, 40000)})
+
+def login(client, username: str, forwarded: str = None):
+    headers = {"X-Forwarded-For": forwarded} if forwarded else {}
+    return client.post(
+        "/auth/login", json={"username": username, "password": "x", "hwid": "hwid"}, headers=headers
+    )
+
+@pytest.fixture
+def behind_proxy(monkeypatch):
+    monkeypatch.setattr(api, "TRUST_PROXY_HEADERS", True)
+    monkeypatch.setattr(api, "TRUSTED_PROXY_HOPS", 1)
+
+@pytest.fixture
+def strict_ip_limit(monkeypatch):
+    # Только лимит на IP: каждая попытка идёт с новым логином
+    limits = admission.LoginAdmission(
+        ip_per_minute=1, ip_burst=2, user_per_minute=0, user_burst=1, max_concurrent=100, max_keys=1000
+    )
+    monkeypatch.setattr(admission, "admission", limits)
+    return limits
+
+def test_client_ip_uses_peer_without_proxy_trust():
+    assert api.client_ip(make_request("198.51.100.1", "203.0.113.7")) == "198.51.100.1"
+
+def test_client_ip_ignores_spoofed_leftmost_entry(behind_proxy):
+    assert api.client_ip(make_request("10.0.0.1", "6.6.6.6, 203.0.113.7")) == "203.0.113.7"
+    # Несколько заголовков X-Forwarded-For - один список
+    assert api.client_ip(make_request("10.0.0.1", "6.6.6.6", "203.0.113.7")) == "203.0.113.7"
+
+def test_client_ip_counts_trusted_hops(behind_proxy, monkeypatch):
+    monkeypatch.setattr(api, "TRUSTED_PROXY_HOPS", 2)
+    assert api.client_ip(make_request("10.0.0.1", "6.6.6.6, 203.0.113.7, 10.0.0.2")) == "203.0.113.7"
+    # Записей меньше, чем прокси: запрос пришёл в обход цепочки
+    assert api.client_ip(make_request("10.0.0.1", "203.0.113.7")) == "10.0.0.1"
+
+def test_spoofed_forwarded_for_does_not_reset_ip_limit(client, behind_proxy, strict_ip_limit):
+    statuses = [
+        login(client, f"spoof{i}", forwarded=f"6.6.6.{i}, 203.0.113.7").status_code
+        for i in range(4)
+    ]
+    assert statuses == [200, 200, 429, 429]
+
+def test_ip_limit_off_without_proxy_trust(client):
+    # За прокси без TRUST_PROXY_HEADERS у всех клиентов адрес прокси - общий лимит на всех
+    assert not admission.admission.by_ip.enabled
+    statuses = {login(client, f"shared{i}").status_code for i in range(30)}
+    assert 429 not in statuses
+
+def test_clients_behind_one_proxy_have_own_ip_limits(client, behind_proxy, strict_ip_limit):
+    statuses = [
+        login(client, f"proxied{i}", forwarded=f"203.0.113.{10 + i}").status_code
+        for i in range(10)
+    ]
+    assert statuses == [200] * 10
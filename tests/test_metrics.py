@@ -0,0 +1,31 @@
+import database
+import metrics
+
+def db_calls(function: str) -> int:
+    series = metrics.DB_LATENCY._series.get((function,))
+    return sum(series[:-1]) if series else 0
+
+def test_register_stats_renders_one_series_per_key():
+    stats = {}
+    metrics.register_stats("matrix_test_component", "Test component", lambda: stats, label="state")
+    assert "matrix_test_component{" not in metrics.render()
+    stats.update(workers=2, queued=0)
+    rendered = metrics.render()
+    assert 'matrix_test_component{state="workers"} 2' in rendered
+    assert 'matrix_test_component{state="queued"} 0' in rendered
+
+def test_login_lookups_are_recorded_once(run):
+    async def scenario():
+        await database.create_user(7001, "metrics_user", "hash")
+        before = {name: db_calls(name) for name in ("get_user_by_username", "check_subscription", "authenticate_candidate")}
+        await database.check_subscription("metrics_user")
+        await database.authenticate_candidate("metrics_user")
+        return {name: db_calls(name) - count for name, count in before.items()}
+    assert run(scenario) == {"get_user_by_username": 0, "check_subscription": 1, "authenticate_candidate": 1}
+
+def test_startup_is_timed(run):
+    before = db_calls("init_db"), db_calls("load_sessions")
+    async def scenario():
+        pass
+    run(scenario)
+    assert (db_calls("init_db"), db_calls("load_sessions")) == (before[0] + 1, before[1] + 1)
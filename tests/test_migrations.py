@@ -0,0 +1,56 @@
+import sqlite3
+from datetime import datetime
+
+import database
+
+# Схема users до версионированных миграций (PRAGMA user_version = 0)
+BASELINE_USERS = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        hwid TEXT,
+        subscription_end DATETIME,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        is_active BOOLEAN DEFAULT 1
+    )
+'''
+
+def test_baseline_users_table_is_migrated(run, monkeypatch, tmp_path):
+    path = tmp_path / "baseline.db"
+    future = datetime(2099, 1, 2, 3, 4, 5, 678000)
+    past = datetime(2001, 1, 1, 12, 0)
+    with sqlite3.connect(path) as db:
+        db.execute(BASELINE_USERS)
+        db.executemany(
+            'INSERT INTO users (telegram_id, username, password_hash, subscription_end) VALUES (?, ?, ?, ?)',
+            [
+                (6001, "legacy_active", "hash", future.isoformat()),
+                (6002, "legacy_expired", "hash", past.isoformat()),
+                (6003, "legacy_never", "hash", None),
+            ]
+        )
+    db.close()
+    monkeypatch.setattr(database, "DATABASE_PATH", str(path))
+
+    async def scenario():
+        # Повторный запуск не применяет миграции заново
+        await database.init_db()
+        assert await database.check_subscription("legacy_active")
+        assert not await database.check_subscription("legacy_expired")
+        assert not await database.check_subscription("legacy_never")
+        assert (await database.get_user_by_username("legacy_active"))['password_hash'] == "hash"
+    run(scenario)
+
+    with sqlite3.connect(path) as db:
+        assert db.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+        expires = dict(db.execute('SELECT username, subscription_expires FROM users'))
+        indexes = [row[1] for row in db.execute('PRAGMA index_list(users)')]
+    db.close()
+    assert expires == {
+        "legacy_active": int(future.timestamp()),
+        "legacy_expired": int(past.timestamp()),
+        "legacy_never": None,
+    }
+    assert "idx_users_subscription_expires" in indexes
@@ -0,0 +1,34 @@
+import time
+
+import database
+from config import REFRESH_REUSE_WINDOW_HOURS
+
+async def stored_expiry(token_hash: str):
+    pool = await database.get_pool()
+    async with pool.reader() as db:
+        async with db.execute('SELECT expires_at FROM refresh_tokens WHERE token_hash = ?', (token_hash,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+def test_used_refresh_token_kept_only_for_reuse_window(run):
+    async def scenario():
+        now = int(time.time())
+        await database.create_refresh_token("used-hash", "alice", "hwid", "family-1", 0, now + 30 * 86400)
+        await database.create_refresh_token("next-hash", "alice", "hwid", "family-1", 0, now + 30 * 86400)
+        assert (await database.consume_refresh_token("used-hash"))['username'] == "alice"
+        assert await stored_expiry("used-hash") <= now + REFRESH_REUSE_WINDOW_HOURS * 3600 + 1
+        # Повторное предъявление внутри окна отзывает всё семейство
+        assert await database.consume_refresh_token("used-hash") is None
+        assert await stored_expiry("used-hash") is None
+        assert await stored_expiry("next-hash") is None
+    run(scenario)
+
+def test_prune_expired_tokens(run):
+    async def scenario():
+        now = int(time.time())
+        await database.create_refresh_token("stale-hash", "bob", "hwid", "family-2", 0, now - 1)
+        await database.create_refresh_token("live-hash", "bob", "hwid", "family-3", 0, now + 3600)
+        await database.prune_expired_tokens()
+        assert await stored_expiry("stale-hash") is None
+        assert await stored_expiry("live-hash") == now + 3600
+    run(scenario)
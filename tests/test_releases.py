@@ -0,0 +1,102 @@
+import json
+import os
+
+import pytest
+
+import releases
+
+@pytest.fixture
+def manifest_file(monkeypatch, tmp_path):
+    """Файл манифеста только для этого теста; текущий манифест восстанавливается."""
+    path = tmp_path / "releases.json"
+    monkeypatch.setattr(releases, "RELEASE_MANIFEST_PATH", str(path))
+    monkeypatch.setattr(releases, "_manifest", releases._manifest)
+    monkeypatch.setattr(releases, "_manifest_mtime", None)
+    monkeypatch.setattr(releases, "_next_check", 0.0)
+    return path
+
+def write_manifest(path, content: str, mtime_ns: int):
+    path.write_text(content, encoding="utf-8")
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def body(prepared) -> dict:
+    return json.loads(prepared.body)
+
+def test_versions_follow_semver_precedence():
+    ordered = [
+        "1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-alpha.beta", "1.0.0-beta",
+        "1.0.0-beta.2", "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0", "1.0.1", "1.10.0",
+    ]
+    keys = [releases.parse_version(version) for version in ordered]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+def test_numeric_prerelease_identifiers_sort_before_alphanumeric():
+    assert releases.parse_version("1.0.0-2") < releases.parse_version("1.0.0-10")
+    assert releases.parse_version("1.0.0-10") < releases.parse_version("1.0.0-a")
+
+def test_missing_parts_and_build_metadata_are_ignored():
+    assert releases.parse_version("1.2") == releases.parse_version("v1.2.0+build.7")
+    assert releases.parse_version("1.2.x") is None
+
+def test_malformed_client_version_gets_the_update():
+    manifest = releases.build_manifest({"channels": {"stable": {"version": "1.2.0"}}})
+    assert body(manifest.check("stable", "not-a-version"))["update_available"] is True
+    assert body(manifest.check("stable", "1.2.0"))["update_available"] is False
+    assert body(manifest.check("stable", "1.2.0-rc.1"))["update_available"] is True
+
+def test_unknown_channel_falls_back_to_stable():
+    manifest = releases.build_manifest({"channels": {
+        "stable": {"version": "1.2.0"},
+        "beta": {"version": "1.3.0-beta"},
+    }})
+    assert manifest.check("nightly", "1.0.0") is manifest.check("stable", "1.0.0")
+    assert body(manifest.check("beta", "1.2.0"))["latest_version"] == "1.3.0-beta"
+
+def test_channel_behind_stable_serves_stable():
+    manifest = releases.build_manifest({"channels": {
+        "stable": {"version": "2.0.0"},
+        "beta": {"version": "2.0.0-beta.3"},
+    }})
+    assert manifest.channels["beta"] is manifest.channels["stable"]
+    assert body(manifest.check("beta", "2.0.0-beta.3"))["latest_version"] == "2.0.0"
+
+def test_broken_manifest_keeps_previous_one(manifest_file):
+    write_manifest(manifest_file, json.dumps({"channels": {"stable": {"version": "3.0.0"}}}), 1_000_000_000)
+    releases._reload()
+    assert releases._manifest.channels["stable"].version == "3.0.0"
+
+    for broken in ('{"channels": ', '{"channels": {"stable": {}}}', '{"channels": {"stable": {"version": "x"}}}'):
+        write_manifest(manifest_file, broken, releases._manifest_mtime + 1_000_000_000)
+        releases._reload()
+        assert releases._manifest.channels["stable"].version == "3.0.0"
+
+    write_manifest(manifest_file, json.dumps({"channels": {"stable": {"version": "3.1.0"}}}), releases._manifest_mtime + 1_000_000_000)
+    releases._reload()
+    assert releases._manifest.channels["stable"].version == "3.1.0"
+
+def test_update_check_revalidates_with_etag(client, manifest_file):
+    write_manifest(manifest_file, json.dumps({"channels": {"stable": {
+        "version": "1.5.0", "download_url": "https://example.com/loader.exe", "changelog": "fixes",
+    }}}), 1_000_000_000)
+
+    response = client.get("/update/check", params={"version": "1.4.0"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "update_available": True,
+        "latest_version": "1.5.0",
+        "download_url": "https://example.com/loader.exe",
+        "changelog": "fixes",
+    }
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == releases.CACHE_CONTROL
+
+    cached = client.get("/update/check", params={"version": "1.4.0"}, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["etag"] == etag
+
+    current = client.get("/update/check", params={"version": "1.5.0"}, headers={"If-None-Match": etag})
+    assert current.status_code == 200
+    assert current.json()["update_available"] is False
+    assert current.headers["etag"] != etag
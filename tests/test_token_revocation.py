@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import api
+import database
+import sessions
+
+def bearer(token: str) -> HTTPAuthorizationCredentials:
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+def assert_revoked(token: str):
+    with pytest.raises(HTTPException) as error:
+        api.decode_token(bearer(token))
+    assert error.value.status_code == 401
+
+async def issue_token(username: str) -> str:
+    user = await database.authenticate_candidate(username)
+    return api.create_token(username, user['token_generation'], user['subscription_expires'])
+
+async def create_subscriber(telegram_id: int, username: str, days: int = 30):
+    await database.create_user(telegram_id, username, "hash")
+    await database.set_subscription(username, datetime.now() + timedelta(days=days))
+
+@pytest.mark.parametrize("telegram_id, revoke", [(8001, database.ban_user), (8002, database.reset_hwid)])
+def test_ban_and_hwid_reset_revoke_issued_tokens(run, telegram_id, revoke):
+    username = f"revoke_{revoke.__name__}"
+    
+    async def scenario():
+        await create_subscriber(telegram_id, username)
+        token = await issue_token(username)
+        assert api.decode_token(bearer(token))["sub"] == username
+        
+        await revoke(username)
+        assert_revoked(token)
+        # Токен, выданный после этого, снова действителен
+        assert api.decode_token(bearer(await issue_token(username)))["sub"] == username
+    run(scenario)
+
+def test_only_shortened_subscription_revokes_tokens(run):
+    async def scenario():
+        await create_subscriber(8101, "revoke_subscription", days=30)
+        token = await issue_token("revoke_subscription")
+        
+        await database.set_subscription("revoke_subscription", datetime.now() + timedelta(days=60))
+        assert api.decode_token(bearer(token))["sub"] == "revoke_subscription"
+        
+        await database.set_subscription("revoke_subscription", datetime.now() + timedelta(days=10))
+        assert_revoked(token)
+    run(scenario)
+
+def test_logout_revokes_only_that_token_and_survives_restart(run):
+    tokens = []
+    
+    async def scenario():
+        await create_subscriber(8102, "revoke_logout")
+        tokens.extend([await issue_token("revoke_logout"), await issue_token("revoke_logout")])
+        await api.logout(api.decode_token(bearer(tokens[0])))
+    run(scenario)
+    assert_revoked(tokens[0])
+    assert api.decode_token(bearer(tokens[1]))["sub"] == "revoke_logout"
+    
+    # Новый процесс: реестр загружается из БД при init_db
+    sessions.load({}, {})
+    run(lambda: database.get_user_by_username("revoke_logout"))
+    assert_revoked(tokens[0])
@@ -0,0 +1,55 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+import updates
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(chat_id, Chat.PRIVATE)))
+
+def test_updates_of_one_chat_run_in_order():
+    async def scenario():
+        processor = updates.PerChatUpdateProcessor(limit=8)
+        log = []
+
+        async def handle(update_id: int, delay: float):
+            log.append(("start", update_id))
+            await asyncio.sleep(delay)
+            log.append(("end", update_id))
+
+        # Первые обновления обрабатываются дольше: без блокировки чата порядок бы сломался
+        await asyncio.gather(*(
+            processor.process_update(make_update(i, 100), handle(i, 0.05 - i * 0.01))
+            for i in range(5)
+        ))
+        assert log == [(kind, i) for i in range(5) for kind in ("start", "end")]
+        assert processor.stats() == {"limit": 8, "running": 0, "pending": 0, "chats": 0}
+    asyncio.run(scenario())
+
+def test_different_chats_run_in_parallel_up_to_limit():
+    async def scenario():
+        processor = updates.PerChatUpdateProcessor(limit=2)
+        other_started = asyncio.Event()
+        peak = 0
+
+        async def first():
+            # Ждёт обработчик другого чата: без параллелизма это взаимоблокировка
+            await asyncio.wait_for(other_started.wait(), 1)
+
+        async def second():
+            other_started.set()
+
+        async def busy():
+            nonlocal peak
+            peak = max(peak, processor.running)
+            await asyncio.sleep(0.01)
+
+        await asyncio.gather(
+            processor.process_update(make_update(1, 201), first()),
+            processor.process_update(make_update(2, 202), second()),
+        )
+        await asyncio.gather(*(processor.process_update(make_update(10 + i, 300 + i), busy()) for i in range(6)))
+        assert peak == 2
+        assert processor.stats()["chats"] == 0
+    asyncio.run(scenario())
@@ -0,0 +1,57 @@
+import time
+from datetime import datetime, timedelta
+
+import database
+from cache import MISSING, TTLCache
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    assert cache.get("a") is MISSING
+
+def test_every_writer_invalidates_cached_user(run):
+    async def scenario():
+        await database.create_user(5001, "cache_writer", "hash-1")
+        subscription_end = datetime.now() + timedelta(days=3)
+        writes = [
+            (lambda: database.update_hwid("cache_writer", "hwid-1"), "hwid", "hwid-1"),
+            (lambda: database.update_password_hash("cache_writer", "hash-2"), "password_hash", "hash-2"),
+            (lambda: database.reset_hwid("cache_writer"), "hwid", None),
+            (lambda: database.set_subscription("cache_writer", subscription_end),
+             "subscription_end", subscription_end.isoformat()),
+            (lambda: database.ban_user("cache_writer"), "is_active", 0),
+        ]
+        for write, column, expected in writes:
+            # Строка в кэше до записи - после записи читается новая
+            assert await database.get_user_by_username("cache_writer") is not None
+            await write()
+            assert (await database.get_user_by_username("cache_writer"))[column] == expected
+            assert (await database.get_user_by_telegram_id(5001))[column] == expected
+    run(scenario)
+
+def test_read_started_before_write_is_not_cached(run):
+    async def scenario():
+        await database.create_user(5002, "cache_race", "hash")
+        database.invalidate_user("cache_race")
+        generation = database._cache_generation
+        stale = await database.get_user_by_username("cache_race")
+        database.invalidate_user("cache_race")
+        
+        # Чтение началось до записи и завершилось после неё
+        database._cache_user(stale, generation)
+        assert database._users.get("cache_race") is MISSING
+        database._cache_user(stale, database._cache_generation)
+        assert database._users.get("cache_race") is stale
+    run(scenario)
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+
+# id -> (подписка активна, забанен, HWID привязан)
+USERS = {
+    1: (True, False, False),
+    2: (False, True, False),
+    3: (True, False, True),
+    4: (False, False, True),
+    5: (True, True, False),
+    6: (False, False, False),
+    7: (True, False, True),
+}
+EXPECTED = {
+    'all': [7, 6, 5, 4, 3, 2, 1],
+    'active': [7, 5, 3, 1],
+    'expired': [6, 4, 2],
+    'banned': [5, 2],
+    'hwid': [7, 4, 3],
+}
+
+async def create_users():
+    for user_id, (active, banned, hwid) in USERS.items():
+        username = f"page_user_{user_id}"
+        await database.create_user(7000 + user_id, username, "hash")
+        days = 30 if active else -30
+        await database.set_subscription(username, datetime.now() + timedelta(days=days))
+        if banned:
+            await database.ban_user(username)
+        if hwid:
+            await database.update_hwid(username, f"hwid-{user_id}")
+
+def ids(rows):
+    return [int(row['username'].rsplit("_", 1)[1]) for row in rows]
+
+@pytest.mark.parametrize("limit", [2, 3])
+def test_keyset_pages_forward_and_back(run, fresh_db, limit):
+    async def scenario():
+        await create_users()
+        for filter_name, expected in EXPECTED.items():
+            chunks = [expected[i:i + limit] for i in range(0, len(expected), limit)]
+            
+            # Вперёд по ▶️: курсор - последний id страницы
+            pages, after_id = [], None
+            while True:
+                rows, has_newer, has_older = await database.list_users_page(
+                    filter_name, after_id=after_id, limit=limit
+                )
+                pages.append(rows)
+                assert has_newer == (after_id is not None)
+                if not has_older:
+                    break
+                after_id = rows[-1]['id']
+            assert [ids(rows) for rows in pages] == chunks, filter_name
+            
+            # Назад по ◀️ с последней страницы: курсор - первый id страницы
+            back = [pages[-1]]
+            for remaining in range(len(pages) - 2, -1, -1):
+                rows, has_newer, has_older = await database.list_users_page(
+                    filter_name, before_id=back[-1][0]['id'], limit=limit
+                )
+                assert has_older and has_newer == (remaining > 0)
+                back.append(rows)
+            assert [ids(rows) for rows in reversed(back)] == chunks, filter_name
+    run(scenario)
+
+def test_empty_filter_has_no_navigation(run, fresh_db):
+    async def scenario():
+        assert await database.list_users_page('banned', limit=5) == ([], False, False)
+    run(scenario)
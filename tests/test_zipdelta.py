@@ -0,0 +1,155 @@
+import hashlib
+import os
+import random
+import zipfile
+
+import pytest
+
+import api
+import artifacts
+import zipdelta
+
+def sha256_file(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def write_jar(path, entries: dict, date_time):
+    with zipfile.ZipFile(path, "w") as jar:
+        for name, data in entries.items():
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.compress_type = zipfile.ZIP_STORED
+            jar.writestr(info, data)
+    return str(path)
+
+def random_bytes(seed: int, size: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+OLD_ENTRIES = {
+    "META-INF/MANIFEST.MF": b"Manifest-Version: 1.0\r\n",
+    "a/Main.class": random_bytes(1, 40_000),
+    "a/Util.class": random_bytes(2, 30_000),
+    "assets/logo.png": random_bytes(3, 50_000),
+}
+
+@pytest.fixture
+def jars(tmp_path):
+    """Две версии JAR: изменён один класс, у всех записей другое время."""
+    old = write_jar(tmp_path / "old.jar", OLD_ENTRIES, (2024, 1, 1, 12, 0, 0))
+    new_entries = dict(OLD_ENTRIES, **{"a/Util.class": random_bytes(4, 31_000)})
+    new = write_jar(tmp_path / "new.jar", new_entries, (2024, 6, 1, 8, 30, 0))
+    return old, new
+
+def test_delta_reproduces_new_jar_exactly(jars, tmp_path):
+    old, new = jars
+    new_sha256 = sha256_file(new)
+    delta = str(tmp_path / "delta.zip")
+    copied = zipdelta.build(old, new, delta, sha256_file(old), new_sha256)
+
+    out = str(tmp_path / "out.jar")
+    assert zipdelta.apply(old, delta, out) == new_sha256
+    assert sha256_file(out) == new_sha256
+    # Не изменились три записи из четырёх, их данные берутся из старого файла
+    assert copied >= 40_000 + 50_000
+    assert os.path.getsize(delta) < os.path.getsize(new) - copied + 2_000
+
+def test_apply_rejects_unknown_format(jars, tmp_path):
+    old, new = jars
+    delta = str(tmp_path / "delta.zip")
+    with zipfile.ZipFile(delta, "w") as out:
+        out.writestr("delta.json", '{"format": 99, "ops": []}')
+        out.writestr("data.bin", b"")
+    with pytest.raises(zipdelta.DeltaError):
+        zipdelta.apply(old, delta, str(tmp_path / "out.jar"))
+
+def make_cache(cache_dir, old: str, new: str) -> artifacts.ArtifactCache:
+    """Кэш с двумя версиями на диске, без обращений к апстриму."""
+    cache = artifacts.ArtifactCache("https://example.com/client.jar", str(cache_dir), 3600, 16 * 1024, keep_versions=5)
+    os.makedirs(cache.cache_dir, exist_ok=True)
+    history = []
+    for path in (new, old):
+        sha256 = sha256_file(path)
+        with open(path, "rb") as src, open(cache._jar_path(sha256), "wb") as dst:
+            dst.write(src.read())
+        history.append(sha256)
+    cache.history = history
+    cache.current = artifacts.Artifact(cache.url, '"upstream"', history[0], os.path.getsize(new), cache._jar_path(history[0]))
+    cache._build_deltas(history)
+    return cache
+
+def test_delta_is_published_only_when_much_smaller(jars, tmp_path):
+    old, new = jars
+    cache = make_cache(tmp_path / "small", old, new)
+    assert os.path.isfile(cache._delta_path(cache.history[1], cache.history[0]))
+
+    # Изменились все записи: дельта не меньше 90% файла и не публикуется
+    rewritten = write_jar(tmp_path / "rewritten.jar", {
+        name: random_bytes(100 + i, len(data)) for i, (name, data) in enumerate(OLD_ENTRIES.items())
+    }, (2024, 6, 1, 8, 30, 0))
+    cache = make_cache(tmp_path / "rewritten", old, rewritten)
+    assert not os.path.exists(cache._delta_path(cache.history[1], cache.history[0]))
+    assert [name for name in os.listdir(cache.cache_dir) if not name.endswith(".jar")] == []
+
+@pytest.fixture
+def served(client, monkeypatch, jars, tmp_path):
+    old, new = jars
+    cache = make_cache(tmp_path / "cache", old, new)
+    monkeypatch.setattr(api, "artifact_cache", cache)
+    return cache, old, {"Authorization": f"Bearer {api.create_token('delta_user')}"}
+
+def test_download_ranges(client, served):
+    cache, _, auth = served
+    with open(cache.current.path, "rb") as f:
+        content = f.read()
+    etag = cache.current.http_etag
+
+    full = client.get("/client/download", headers=auth)
+    assert full.status_code == 200
+    assert full.content == content
+    assert full.headers["x-content-sha256"] == cache.current.sha256
+
+    partial = client.get("/client/download", headers={**auth, "Range": "bytes=100-199", "If-Range": etag})
+    assert partial.status_code == 206
+    assert partial.content == content[100:200]
+    assert partial.headers["content-range"] == f"bytes 100-199/{len(content)}"
+
+    suffix = client.get("/client/download", headers={**auth, "Range": "bytes=-10"})
+    assert suffix.status_code == 206
+    assert suffix.content == content[-10:]
+
+    # If-Range от другой версии: диапазон игнорируется, файл отдаётся целиком
+    stale = client.get("/client/download", headers={**auth, "Range": "bytes=100-199", "If-Range": '"old"'})
+    assert stale.status_code == 200
+    assert stale.content == content
+
+    beyond = client.get("/client/download", headers={**auth, "Range": f"bytes={len(content)}-"})
+    assert beyond.status_code == 416
+    assert beyond.headers["content-range"] == f"bytes */{len(content)}"
+
+    cached = client.get("/client/download", headers={**auth, "If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+def test_delta_endpoint(client, served, tmp_path):
+    cache, old, auth = served
+    old_sha256 = cache.history[1]
+
+    response = client.get("/client/delta", params={"from": old_sha256.upper()}, headers=auth)
+    assert response.status_code == 200
+    assert response.headers["x-content-sha256"] == cache.current.sha256
+    delta = tmp_path / "downloaded.zip"
+    delta.write_bytes(response.content)
+    assert zipdelta.apply(old, str(delta), str(tmp_path / "rebuilt.jar")) == cache.current.sha256
+
+    etag = response.headers["etag"]
+    partial = client.get("/client/delta", params={"from": old_sha256}, headers={**auth, "Range": "bytes=0-99", "If-Range": etag})
+    assert partial.status_code == 206
+    assert partial.content == response.content[:100]
+
+    beyond = client.get("/client/delta", params={"from": old_sha256}, headers={**auth, "Range": f"bytes={len(response.content)}-"})
+    assert beyond.status_code == 416
+
+    cached = client.get("/client/delta", params={"from": old_sha256}, headers={**auth, "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    for from_sha256 in (cache.current.sha256, "0" * 64):
+        assert client.get("/client/delta", params={"from": from_sha256}, headers=auth).status_code == 404
@@ -0,0 +1,109 @@
+import asyncio
+import contextlib
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+# Семафор BaseUpdateProcessor берётся до do_process_update, то есть до
+# блокировки чата: обновления, ждущие своей очереди в чате, занимали бы
+# слоты и тормозили остальных. Поэтому базовый лимит фактически снят,
+# а свой семафор берётся уже после блокировки чата.
+_UNBOUNDED = 2 ** 16
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+    Обновления одного чата (ConversationHandler хранит состояние по чату
+    и пользователю) выполняются строго по очереди, разных чатов - до
+    limit одновременно.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__(_UNBOUNDED)
+        self.limit = max(1, limit)
+        self._slots = asyncio.Semaphore(self.limit)
+        # ключ чата -> [asyncio.Lock, число обновлений в работе и в очереди]
+        self._chats = {}
+        self.pending = 0
+        self.running = 0
+
+    @staticmethod
+    def _chat_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._chat_key(update)
+        lock = self._acquire_chat(key)
+        received = time.perf_counter()
+        started = False
+        self.pending += 1
+        try:
+            # asyncio.Lock пропускает ожидающих по порядку, а задачи
+            # создаются в порядке прихода обновлений
+            async with lock, self._slots:
+                self.pending -= 1
+                self.running += 1
+                started = True
+                metrics.BOT_UPDATE_WAIT.observe(time.perf_counter() - received)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+        finally:
+            if not started:
+                # Отменено в очереди: обновление так и не обработано
+                self.pending -= 1
+                coroutine.close()
+            self._release_chat(key)
+
+    def _acquire_chat(self, key):
+        if key is None:
+            return contextlib.nullcontext()
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_chat(self, key):
+        if key is None:
+            return
+        entry = self._chats[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "pending": self.pending,
+            "chats": len(self._chats),
+        }
+
+processor: PerChatUpdateProcessor = None
+
+def create(limit: int) -> PerChatUpdateProcessor:
+    global processor
+    processor = PerChatUpdateProcessor(limit)
+    return processor
+
+def stats() -> dict:
+    """Пусто, если бот не запущен в этом процессе."""
+    return processor.stats() if processor is not None else {}
+
+metrics.register_stats("matrix_bot_updates", "Bot update processor: running and queued updates", stats)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import struct
+import zipfile
+
+# Дельта между двумя версиями JAR (zip). Результат применения побайтно
+# совпадает с новой версией, поэтому клиент проверяет его тем же sha256,
+# что и полный файл.
+#
+# Дельта - zip с двумя файлами:
+#   delta.json - {"format", "from", "to", "size", "ops"}, где ops - список
+#                ["copy", смещение в старом файле, длина] и
+#                ["data", смещение в data.bin, длина]
+#   data.bin   - байты, которых нет в старом файле
+# Неизменённые записи архива (то же имя, CRC и сжатые данные) копируются
+# из старого файла, изменённые записи, заголовки и central directory
+# лежат в data.bin.
+
+FORMAT = 1
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_COPY_BUF = 1024 * 1024
+
+class DeltaError(Exception):
+    pass
+
+def _entries(zf: zipfile.ZipFile, f):
+    """(имя, crc, тип сжатия, начало сжатых данных, размер сжатых данных) по порядку в файле."""
+    entries = []
+    for info in sorted(zf.infolist(), key=lambda i: i.header_offset):
+        f.seek(info.header_offset)
+        header = f.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size:
+            raise DeltaError(f"Truncated local header for {info.filename}")
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise DeltaError(f"Bad local header for {info.filename}")
+        data_start = info.header_offset + _LOCAL_HEADER.size + fields[10] + fields[11]
+        entries.append((info.filename, info.CRC, info.compress_type, data_start, info.compress_size))
+    return entries
+
+def _same_bytes(a, a_offset: int, b, b_offset: int, length: int) -> bool:
+    a.seek(a_offset)
+    b.seek(b_offset)
+    while length > 0:
+        size = min(_COPY_BUF, length)
+        if a.read(size) != b.read(size):
+            return False
+        length -= size
+    return True
+
+def _plan(old, new, new_size: int):
+    """Разбивает новый файл на участки: ("copy", off_old, len) и ("data", off_new, len)."""
+    with zipfile.ZipFile(old) as old_zip:
+        old_entries = {name: (crc, ctype, start, size) for name, crc, ctype, start, size in _entries(old_zip, old)}
+    with zipfile.ZipFile(new) as new_zip:
+        new_entries = _entries(new_zip, new)
+
+    plan = []
+
+    def add(kind, offset, length):
+        if length <= 0:
+            return
+        if plan and plan[-1][0] == kind and plan[-1][1] + plan[-1][2] == offset:
+            plan[-1] = (kind, plan[-1][1], plan[-1][2] + length)
+        else:
+            plan.append((kind, offset, length))
+
+    position = 0
+    for name, crc, ctype, start, size in new_entries:
+        old_entry = old_entries.get(name)
+        if old_entry is None or old_entry[:2] != (crc, ctype) or old_entry[3] != size or size == 0:
+            continue
+        if not _same_bytes(old, old_entry[2], new, start, size):
+            continue
+        add("data", position, start - position)
+        add("copy", old_entry[2], size)
+        position = start + size
+    add("data", position, new_size - position)
+    return plan
+
+def build(old_path: str, new_path: str, out_path: str, from_sha256: str, to_sha256: str) -> int:
+    """Пишет дельту old -> new в out_path, возвращает число скопированных байт."""
+    new_size = os.path.getsize(new_path)
+    with open(old_path, "rb") as old, open(new_path, "rb") as new:
+        plan = _plan(old, new, new_size)
+        ops = []
+        copied = 0
+        data_offset = 0
+        with zipfile.ZipFile(out_path, "w") as out:
+            with out.open("data.bin", "w", force_zip64=True) as data:
+                for kind, offset, length in plan:
+                    if kind == "copy":
+                        ops.append(["copy", offset, length])
+                        copied += length
+                        continue
+                    new.seek(offset)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = new.read(min(_COPY_BUF, remaining))
+                        if not chunk:
+                            raise DeltaError("Unexpected end of file")
+                        data.write(chunk)
+                        remaining -= len(chunk)
+                    ops.append(["data", data_offset, length])
+                    data_offset += length
+            manifest = {"format": FORMAT, "from": from_sha256, "to": to_sha256, "size": new_size, "ops": ops}
+            out.writestr("delta.json", json.dumps(manifest, separators=(",", ":")), compress_type=zipfile.ZIP_DEFLATED)
+    return copied
+
+def apply(old_path: str, delta_path: str, out_path: str) -> str:
+    """Собирает новую версию из старой и дельты, возвращает sha256 результата.
+
+    Эталонная реализация для лоадера; сервер вызывает её, чтобы проверить
+    дельту перед публикацией.
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(delta_path) as delta:
+        manifest = json.loads(delta.read("delta.json"))
+        if manifest.get("format") != FORMAT:
+            raise DeltaError(f"Unsupported delta format {manifest.get('format')}")
+        with open(old_path, "rb") as old, delta.open("data.bin") as data, open(out_path, "wb") as out:
+            data_position = 0
+            for kind, offset, length in manifest["ops"]:
+                if kind == "copy":
+                    source = old
+                    source.seek(offset)
+                elif kind == "data":
+                    if offset != data_position:
+                        raise DeltaError("Delta data is out of order")
+                    source = data
+                    data_position += length
+                else:
+                    raise DeltaError(f"Unknown op {kind!r}")
+                remaining = length
+                while remaining > 0:
+                    chunk = source.read(min(_COPY_BUF, remaining))
+                    if not chunk:
+                        raise DeltaError("Unexpected end of input")
+                    digest.update(chunk)
+                    out.write(chunk)
+                    remaining -= len(chunk)
+    return digest.hexdigest()